@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+# Upper bound on the elements of one block of resamples, so memory stays flat for any number of candidates
+BLOCK_ELEMENTS = 2 ** 22
+
+
+def rank(a):
+    # Ranks along the last axis with ties getting their average rank, as in scipy.stats.rankdata
+    a = np.asarray(a, dtype=float)
+    n = a.shape[-1]
+    rows = a.reshape(-1, n)
+    order = np.argsort(rows, axis=1, kind="stable")
+    ordered = np.take_along_axis(rows, order, axis=1)
+    new_group = np.ones_like(ordered, dtype=bool)
+    new_group[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    # Number the groups of equal values across all rows at once, then average the ordinal ranks of each group
+    groups = np.cumsum(new_group).reshape(rows.shape) - 1
+    ordinal = np.broadcast_to(np.arange(1, n + 1, dtype=float), rows.shape)
+    average = np.bincount(groups.ravel(), ordinal.ravel()) / np.bincount(groups.ravel())
+    ranks = np.empty_like(rows)
+    np.put_along_axis(ranks, order, average[groups], axis=1)
+    return ranks.reshape(a.shape)
+
+
+def pearson(x, y):
+    # Correlation of every pair of rows along the last axis; constant rows give NaN
+    xc = x - x.mean(axis=-1, keepdims=True)
+    yc = y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (xc * yc).sum(axis=-1) / np.sqrt((xc * xc).sum(axis=-1) * (yc * yc).sum(axis=-1))
+
+
+def spearman(x, y):
+    return pearson(rank(x), rank(y))
+
+
+def _blocks(resamples, n):
+    size = max(1, BLOCK_ELEMENTS // max(n, 1))
+    for start in range(0, resamples, size):
+        yield min(size, resamples - start)
+
+
+def _bootstrap_weights(size, n, rng):
+    # How often each observation is drawn in each resample, so resampled statistics become weighted sums
+    idx = rng.integers(0, n, size=(size, n)) + np.arange(size)[:, None] * n
+    return np.bincount(idx.ravel(), minlength=size * n).reshape(size, n).astype(float)
+
+
+def _weighted_pearson(n, sx, sy, sxx, syy, sxy):
+    cov = sxy / n - sx * sy / n ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = cov / np.sqrt((sxx / n - (sx / n) ** 2) * (syy / n - (sy / n) ** 2))
+    # Resamples of (nearly) constant values leave only rounding noise in the variances
+    return np.where(np.abs(r) <= 1 + 1e-9, np.clip(r, -1, 1), np.nan)
+
+
+def _resample_ranks(weights, values):
+    # Average ranks of every observation within each weighted resample, without sorting the resamples:
+    # the c values below a group of w equal values push it to ranks c + 1 .. c + w
+    order = np.argsort(values, kind="stable")
+    ordered = values[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    group = np.empty(len(values), dtype=int)
+    group[order] = np.cumsum(np.r_[True, ordered[1:] != ordered[:-1]]) - 1
+    group_weights = np.add.reduceat(weights[:, order], starts, axis=1)
+    below = np.cumsum(group_weights, axis=1) - group_weights
+    return (below + (group_weights + 1) / 2)[:, group] - (len(values) + 1) / 2
+
+
+def _correlate_group(x, y, methods, resamples, rng, confidence):
+    # Correlations of every row of x (metrics sharing the same missing values) with y. All metrics and methods
+    # share the same bootstrap resamples and permutations, each evaluated as one matrix product per block.
+    n = x.shape[1]
+    ranked = {"x": rank(x) - (n + 1) / 2, "y": rank(y) - (n + 1) / 2}
+    centered = {"x": x - x.mean(axis=1, keepdims=True), "y": y - y.mean()}
+    values = {method: ranked if method == "spearman" else centered for method in methods}
+    observed = {method: pearson(v["x"], v["y"]) for method, v in values.items()}
+    bootstrap = {method: [] for method in methods}
+    extreme = {method: np.zeros(len(x), dtype=int) for method in methods}
+
+    for size in _blocks(resamples, n):
+        weights = _bootstrap_weights(size, n, rng)
+        counts = weights.sum(axis=1)[:, None]
+        permutations = rng.permuted(np.broadcast_to(np.arange(n), (size, n)), axis=1)
+        resampled_y_ranks = None
+        for method, v in values.items():
+            xs, ys = v["x"], v["y"]
+            if method == "spearman":
+                if resampled_y_ranks is None:
+                    resampled_y_ranks = _resample_ranks(weights, y)
+                ry = resampled_y_ranks
+                estimates = []
+                for row in x:
+                    rx = _resample_ranks(weights, row)
+                    estimates.append(_weighted_pearson(counts[:, 0], (weights * rx).sum(1), (weights * ry).sum(1),
+                                                       (weights * rx * rx).sum(1), (weights * ry * ry).sum(1),
+                                                       (weights * rx * ry).sum(1)))
+                bootstrap[method].append(np.stack(estimates, axis=1))
+            else:
+                bootstrap[method].append(_weighted_pearson(
+                    counts, weights @ xs.T, (weights @ ys)[:, None], weights @ (xs * xs).T,
+                    (weights @ (ys * ys))[:, None], weights @ (xs * ys).T))
+            # Shuffling y leaves its spread unchanged, so only the cross products need recomputing
+            with np.errstate(divide="ignore", invalid="ignore"):
+                shuffled = (ys[permutations] @ xs.T) / np.sqrt((xs * xs).sum(axis=1) * (ys * ys).sum())
+            # Tolerance keeps ties with the observed value from being lost to rounding
+            extreme[method] += (np.abs(shuffled) >= np.abs(observed[method]) - 1e-12).sum(axis=0)
+
+    alpha = (1 - confidence) / 2
+    results = []
+    for method in methods:
+        estimates = np.concatenate(bootstrap[method])
+        for j in range(len(x)):
+            column = estimates[:, j]
+            column = column[~np.isnan(column)]
+            ci = np.quantile(column, [alpha, 1 - alpha]) if len(column) else (np.nan, np.nan)
+            r = float(observed[method][j])
+            results.append({"method": method, "row": j, "n": n, "r": r, "ci_low": ci[0], "ci_high": ci[1],
+                            "p_value": np.nan if np.isnan(r) else (extreme[method][j] + 1) / (resamples + 1)})
+    return results
+
+
+def correlation_table(df, columns, target, methods, level, resamples=2000, seed=0, confidence=0.95):
+    rng = np.random.default_rng(seed)
+    y = pd.to_numeric(df[target], errors="coerce").to_numpy(dtype=float)
+    columns = [column for column in columns if column != target and column in df.columns]
+    x = np.stack([pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=float) for column in columns]) \
+        if columns else np.empty((0, len(y)))
+    present = ~(np.isnan(x) | np.isnan(y))
+
+    # Metrics missing on the same observations are correlated together
+    groups = {}
+    for j, mask in enumerate(present):
+        groups.setdefault(mask.tobytes(), []).append(j)
+    rows = []
+    for indices in groups.values():
+        mask = present[indices[0]]
+        if mask.sum() < 3:
+            rows += [{"metric": columns[j], "method": method, "n": int(mask.sum()), "r": np.nan, "ci_low": np.nan,
+                      "ci_high": np.nan, "p_value": np.nan} for j in indices for method in methods]
+            continue
+        for result in _correlate_group(x[indices][:, mask], y[mask], methods, resamples, rng, confidence):
+            result["metric"] = columns[indices[result.pop("row")]]
+            rows.append(result)
+    table = pd.DataFrame(rows, columns=["metric", "method", "n", "r", "ci_low", "ci_high", "p_value"])
+    table.insert(0, "level", level)
+    table.insert(2, "target", target)
+    order = {column: i for i, column in enumerate(columns)}
+    return table.sort_values("metric", key=lambda s: s.map(order), kind="stable").reset_index(drop=True)
+
+
+def task_correlations(tasks_df, columns=None, target="pass@k", **kwargs):
+    # Per-task metric values (task metrics and candidate means) against the task's pass@k
+    if columns is None:
+        columns = tasks_df.select_dtypes(include=[np.number]).columns
+    return correlation_table(tasks_df, columns, target, ["pearson", "spearman"], "task", **kwargs)
+
+
+def candidate_correlations(candidates_df, columns, target="passed", **kwargs):
+    # Per-candidate metric values against whether the candidate passed its tests. Point-biserial correlation is
+    # Pearson's with a binary variable, so it goes through the same code path
+    return correlation_table(candidates_df, columns, target, ["point_biserial", "spearman"], "candidate", **kwargs)
@@ -0,0 +1,155 @@
+import ast
+import signal
+import time
+
+from code_cache import cached, candidate_namespace, test_code
+
+
+# Raised by the timer on an over-budget test. A BaseException, so candidates catching Exception cannot swallow it.
+class TestTimeout(BaseException):
+    pass
+
+
+# Name the current case of a split test loop is bound to before its target is assigned
+CASE = "__test_case__"
+
+
+def _on_alarm(signum, frame):
+    raise TestTimeout()
+
+
+def _contains_assert(node):
+    return any(isinstance(child, ast.Assert) for child in ast.walk(node))
+
+
+def _calls(node, names):
+    return any(isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and child.func.id in names
+               for child in ast.walk(node))
+
+
+def _splittable_loop(statement):
+    # A for loop over test cases (e.g. HumanEval+'s for inp, exp in zip(inputs, results)) whose iterations can run
+    # one by one: nothing in its body refers to the loop itself
+    return isinstance(statement, ast.For) and not statement.orelse and \
+        not any(isinstance(node, (ast.Break, ast.Continue)) for node in ast.walk(statement))
+
+
+def split_check(test_code):
+    # Splits the dataset's test code into the module-level prelude (METADATA, imports, helpers) and the statements
+    # of check(candidate). Statements that assert, call the candidate or call a prelude helper that asserts are
+    # tests, the others set up state for the following tests. A test loop over cases is split into its iterations.
+    # Returns None when there is no check function to split, e.g. for a custom test harness.
+    module = ast.parse(test_code)
+    checks = [node for node in module.body if isinstance(node, ast.FunctionDef) and node.name == "check"]
+    if len(checks) != 1 or len(checks[0].args.args) != 1:
+        return None
+    check = checks[0]
+    parameter = check.args.args[0].arg
+    if any(isinstance(node, (ast.Return, ast.Nonlocal, ast.Global)) for node in ast.walk(check)):
+        return None
+    prelude = ast.Module(body=[node for node in module.body if node is not check], type_ignores=[])
+    # e.g. HumanEval+'s assertion(out, exp, atol) holds the assert of every test
+    asserting = {node.name for node in prelude.body
+                 if isinstance(node, ast.FunctionDef) and _contains_assert(node)} | {parameter}
+    units = []
+    for statement in check.body:
+        is_test = _contains_assert(statement) or _calls(statement, asserting)
+        if is_test and _splittable_loop(statement):
+            target = ast.Assign(targets=[statement.target], value=ast.Name(id=CASE, ctx=ast.Load()))
+            loop = (compile(ast.fix_missing_locations(ast.Module(body=[target], type_ignores=[])), "<test>", "exec"),
+                    compile(ast.Module(body=statement.body, type_ignores=[]), "<test>", "exec"))
+            # The cases are listed up front, as setup on its own budget
+            cases = ast.Assign(targets=[ast.Name(id=CASE, ctx=ast.Store())],
+                               value=ast.Call(func=ast.Name(id="list", ctx=ast.Load()), args=[statement.iter],
+                                              keywords=[]))
+            code = compile(ast.fix_missing_locations(ast.Module(body=[ast.copy_location(cases, statement)],
+                                                                type_ignores=[])), "<test>", "exec")
+        else:
+            loop = None
+            code = compile(ast.Module(body=[statement], type_ignores=[]), "<test>", "exec")
+        units.append((statement.lineno, is_test, code, loop))
+    return compile(prelude, "<test>", "exec"), parameter, units
+
+
+def _timed(code, namespace, test_timeout):
+    # (failure or None, duration) of running code on its own time budget
+    start = time.perf_counter()
+    signal.setitimer(signal.ITIMER_REAL, test_timeout)
+    try:
+        exec(code, namespace)
+        failure = None
+    except BaseException as e:
+        failure = e
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    if failure is not None and not isinstance(failure, (Exception, TestTimeout)):
+        raise failure  # SystemExit and friends end the candidate like in the whole-check mode
+    return failure, time.perf_counter() - start
+
+
+def _describe(error):
+    if isinstance(error, TestTimeout):
+        return "Timeout"
+    return f"{type(error).__name__}: {error}"
+
+
+# Runs inside a sandbox worker: executes every assertion of check(candidate) on its own time budget instead of
+# the whole check function as one unit. Stops at the first failing test unless run_all is set.
+def run_test_cases(prompt, solution, entry_point, test_source, test_timeout, run_all=False):
+    split = cached("split", test_source, split_check)
+    namespace = candidate_namespace(prompt, solution, entry_point)
+    if split is None:
+        exec(test_code(test_source), namespace)
+        start = time.perf_counter()
+        namespace["check"](namespace["candidate"])
+        return {"passed": True, "error": None,
+                "tests": [{"line": None, "passed": True, "duration": time.perf_counter() - start, "error": None}]}
+
+    prelude, parameter, units = split
+    exec(prelude, namespace)
+    namespace[parameter] = namespace["candidate"]
+    tests = []
+    error = None
+
+    def record(line, is_test, failure, duration, case=None):
+        # Whether to go on with the next test
+        nonlocal error
+        if is_test or failure is not None:
+            test = {"line": line, "passed": failure is None, "duration": duration,
+                    "error": None if failure is None else _describe(failure)}
+            if case is not None:
+                test["case"] = case
+            tests.append(test)
+        if failure is None:
+            return True
+        error = error or f"line {line}{'' if case is None else f' case {case}'}: {_describe(failure)}"
+        # A failed setup statement leaves the following tests without their state
+        return run_all and is_test
+
+    previous = signal.signal(signal.SIGALRM, _on_alarm)
+    try:
+        for line, is_test, code, loop in units:
+            if loop is None:
+                failure, duration = _timed(code, namespace, test_timeout)
+                if not record(line, is_test, failure, duration):
+                    break
+                continue
+            # Every iteration of a split loop is a test with its own budget
+            failure, duration = _timed(code, namespace, test_timeout)
+            if not record(line, False, failure, duration):
+                break
+            assign, body = loop
+            go_on = True
+            for case, value in enumerate(namespace.pop(CASE)):
+                namespace[CASE] = value
+                failure, duration = _timed(assign, namespace, test_timeout)
+                if failure is None:
+                    failure, duration = _timed(body, namespace, test_timeout)
+                go_on = record(line, True, failure, duration, case)
+                if not go_on:
+                    break
+            if not go_on:
+                break
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+    return {"passed": error is None, "error": error, "tests": tests}
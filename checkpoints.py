@@ -0,0 +1,177 @@
+import json
+import os
+from pathlib import Path
+
+from utils import iter_jsonl
+
+STAGE_OUTPUTS = ["generated_solutions.jsonl", "evaluation_results.jsonl", "metrics.jsonl"]
+
+
+def record_key(record):
+    return record["task_id"], record["candidate_index"]
+
+
+def checkpoint_path(output_path: Path) -> Path:
+    return output_path.with_suffix(".checkpoint.jsonl")
+
+
+def read_jsonl(path: Path):
+    return list(iter_jsonl(path))
+
+
+def truncate_torn_tail(path: Path):
+    # Cut the file after its last newline: a line without one is the torn tail of a write interrupted by a crash
+    with path.open("rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            chunk_start = max(0, position - 65536)
+            f.seek(chunk_start)
+            newline = f.read(position - chunk_start).rfind(b"\n")
+            if newline != -1:
+                f.truncate(chunk_start + newline + 1)
+                return
+            position = chunk_start
+        f.truncate(0)
+
+
+# Writes a JSONL file next to its destination and moves it into place only once it is complete,
+# so readers never see a half-written output
+class AtomicJsonlWriter:
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".tmp")
+        self.file = None
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def __enter__(self):
+        self.file = self.tmp_path.open("w")
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.file.close()
+            self.tmp_path.unlink(missing_ok=True)
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def atomic_write_jsonl(path: Path, records):
+    with AtomicJsonlWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+
+
+# Append-only journal of per-(task_id, candidate_index) records of one stage. Each record is flushed as soon as
+# it is added, so a crashed stage resumes from the last finished candidate. Later records replace earlier ones.
+# Only the file offset of every record is kept in memory; records are read back on demand.
+class Checkpoint:
+    def __init__(self, path: Path):
+        self.path = path
+        self.offsets = {}
+        if path.exists():
+            truncate_torn_tail(path)
+            with path.open("rb") as f:
+                offset = 0
+                for line in f:
+                    self.offsets[record_key(json.loads(line))] = offset
+                    offset += len(line)
+        self.file = path.open("ab")
+        self.reader = path.open("rb")
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, key, default=None):
+        if key not in self.offsets:
+            return default
+        self.reader.seek(self.offsets[key])
+        return json.loads(self.reader.readline())
+
+    def add(self, record):
+        offset = self.file.seek(0, os.SEEK_END)
+        self.file.write((json.dumps(record) + "\n").encode())
+        self.file.flush()
+        self.offsets[record_key(record)] = offset
+
+    def ordered(self, keys):
+        return [self.get(key) for key in keys if key in self.offsets]
+
+    def close(self):
+        self.file.close()
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_path(config, runs_path: Path) -> Path:
+    # The run's directory, or the one an earlier version named with k so that existing runs keep resuming
+    work_path = runs_path.joinpath(config.get_label())
+    legacy_path = runs_path.joinpath(config.get_legacy_label())
+    if not work_path.exists() and legacy_path.exists():
+        print(f"Continuing the run in {legacy_path}")
+        return legacy_path
+    return work_path
+
+
+def save_run_config(config, work_path: Path):
+    with work_path.joinpath("config.json").open("w") as f:
+        f.write(config.model_dump_json(indent=2))
+
+
+def _same_generation_setup(config, other_config):
+    return (other_config["model"] == config.model.model_dump()
+            and other_config["data"]["dataset"] == config.data.dataset)
+
+
+def _read_stage_records(run_path: Path, name):
+    # Generated solutions are per candidate in the final file as well, later stages only in their checkpoints
+    sources = [run_path.joinpath(name)] if name == STAGE_OUTPUTS[0] else []
+    sources.append(checkpoint_path(run_path.joinpath(name)))
+    return {record_key(record): record for source in sources for record in read_jsonl(source)}
+
+
+def seed_from_previous_runs(config, work_path: Path, task_ids):
+    # Reuse candidates of earlier runs with the same model, prompt and dataset (e.g. a run with fewer
+    # candidates), so that only the missing (task_id, candidate_index) pairs are computed for this run
+    solutions_checkpoint = checkpoint_path(work_path.joinpath(STAGE_OUTPUTS[0]))
+    if solutions_checkpoint.exists():
+        return
+    task_ids = set(task_ids)
+
+    def in_scope(record):
+        return record["task_id"] in task_ids and record["candidate_index"] < config.evaluation.candidates
+
+    seeded = {name: {} for name in STAGE_OUTPUTS}
+    for run_path in sorted(work_path.parent.iterdir()):
+        config_path = run_path.joinpath("config.json")
+        if run_path == work_path or not config_path.exists():
+            continue
+        with config_path.open() as f:
+            if not _same_generation_setup(config, json.load(f)):
+                continue
+        stage_records = [_read_stage_records(run_path, name) for name in STAGE_OUTPUTS]
+        for key, solution in stage_records[0].items():
+            if not in_scope(solution) or key in seeded[STAGE_OUTPUTS[0]]:
+                continue
+            # Later stages are only valid for the very solution they were computed on, so take them from the same run
+            for name, records in zip(STAGE_OUTPUTS, stage_records):
+                if key in records:
+                    seeded[name][key] = records[key]
+
+    for name, records in seeded.items():
+        if records:
+            print(f"Reusing {len(records)} records of {name} from previous runs")
+            atomic_write_jsonl(checkpoint_path(work_path.joinpath(name)), records.values())
@@ -0,0 +1,55 @@
+import hashlib
+from collections import OrderedDict
+
+CODE_CACHE_SIZE = 256
+
+# Per worker process: the prompt and test code of a task are the same for all of its candidates, so they are
+# compiled once per worker instead of once per candidate
+_code_cache = OrderedDict()
+
+
+def cached(kind, source, build):
+    key = (kind, hashlib.sha1(source.encode()).hexdigest())
+    if key in _code_cache:
+        _code_cache.move_to_end(key)
+        return _code_cache[key]
+    value = build(source)
+    _code_cache[key] = value
+    if len(_code_cache) > CODE_CACHE_SIZE:
+        _code_cache.popitem(last=False)
+    return value
+
+
+def _compile_or_none(source):
+    try:
+        return compile(source, "<prompt>", "exec")
+    except SyntaxError:
+        return None
+
+
+def compile_candidate(prompt, solution, entry_point):
+    # The prompt and the candidate are run one after the other, which is what executing their concatenation does.
+    # Only when either part does not compile on its own (e.g. a solution that is just the function body)
+    # the concatenation is compiled instead. Raises SyntaxError exactly when the candidate cannot run at all.
+    prompt_code = cached("prompt", prompt.strip(), _compile_or_none)
+    if prompt_code is not None:
+        try:
+            return prompt_code, compile(f"{solution.strip()}\ncandidate = {entry_point}", "<candidate>", "exec")
+        except SyntaxError:
+            pass
+    # Only blank lines are stripped here, the indentation of a body's first line is part of the body
+    body = solution.strip("\n").rstrip()
+    return None, compile(f"{prompt.strip()}\n{body}\ncandidate = {entry_point}", "<candidate>", "exec")
+
+
+def candidate_namespace(prompt, solution, entry_point):
+    namespace = {}
+    prompt_code, solution_code = compile_candidate(prompt, solution, entry_point)
+    if prompt_code is not None:
+        exec(prompt_code, namespace)
+    exec(solution_code, namespace)
+    return namespace
+
+
+def test_code(source):
+    return cached("test", source, lambda text: compile(text, "<test>", "exec"))
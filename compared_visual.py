@@ -1,12 +1,21 @@
 import json
 import argparse
 import os
+from itertools import combinations
+from pathlib import Path
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
+import pyarrow.parquet as pq
 
+from analysis import candidate_correlations
+from run_index import candidate_table, connect, task_field_table
 
-def load_metrics(path):
+
+def load_metrics(path, columns=None):
+    # metrics.parquet is the columnar copy of metrics.jsonl written next to it
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
     records = []
     with open(path, 'r') as f:
         for line in f:
@@ -14,14 +23,21 @@ def load_metrics(path):
     return pd.DataFrame(records)
 
 
-def plot_grouped_bar(merged, label1, label2, field, output_dir):
+def available_columns(path, columns):
+    if not path.endswith('.parquet'):
+        return None
+    names = pq.read_schema(path).names
+    return [c for c in columns if c in names]
+
+
+def plot_grouped_bar(merged, labels, field, output_dir):
     tasks = merged['task_id']
     x = np.arange(len(tasks))
-    width = 0.35
+    width = 0.7 / len(labels)
 
-    fig, ax = plt.subplots(figsize=(max(8, len(tasks)*0.3), 5))
-    ax.bar(x - width/2, merged[f'{field}_{label1}'], width, label=label1)
-    ax.bar(x + width/2, merged[f'{field}_{label2}'], width, label=label2)
+    fig, ax = plt.subplots(figsize=(max(8, len(tasks)*0.15*len(labels)), 5))
+    for i, label in enumerate(labels):
+        ax.bar(x + (i - (len(labels) - 1) / 2) * width, merged[f'{field}_{label}'], width, label=label)
     ax.set_xticks(x)
     ax.set_xticklabels(tasks, rotation=45, ha='right')
     ax.set_ylabel(field)
@@ -33,6 +49,20 @@ def plot_grouped_bar(merged, label1, label2, field, output_dir):
     plt.close()
 
 
+def plot_run_correlation(merged, labels, field, output_dir):
+    corr = merged[[f'{field}_{label}' for label in labels]].corr()
+    plt.figure(figsize=(max(6, len(labels)*0.6), max(6, len(labels)*0.6)))
+    plt.imshow(corr, cmap='coolwarm', vmin=-1, vmax=1)
+    plt.colorbar(label='pearson')
+    ticks = range(len(labels))
+    plt.xticks(ticks, labels, rotation=90)
+    plt.yticks(ticks, labels)
+    plt.title(f'Correlation of {field} between runs')
+    plt.tight_layout()
+    plt.savefig(os.path.join(output_dir, f'correlation_{field}_between_runs.png'))
+    plt.close()
+
+
 def plot_scatter(merged, label1, label2, field, output_dir):
     x = merged[f'{field}_{label1}']
     y = merged[f'{field}_{label2}']
@@ -61,23 +91,10 @@ def plot_diff_histogram(merged, label1, label2, field, output_dir):
     plt.close()
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Compare two HumanEval metrics files and visualize specified metrics"
-    )
-    parser.add_argument('--metrics1', required=True, help='First metrics JSONL file')
-    parser.add_argument('--metrics2', required=True, help='Second metrics JSONL file')
-    parser.add_argument('--label1',   required=True, help='Label for first run (used in legends)')
-    parser.add_argument('--label2',   required=True, help='Label for second run')
-    parser.add_argument('--fields',   required=True, nargs='+',
-                        help='List of metric fields (exact column names) to compare')
-    parser.add_argument('--output-dir', default='compared_visuals', help='Directory to save plots')
-
-    args = parser.parse_args()
-    os.makedirs(args.output_dir, exist_ok=True)
-
-    df1 = load_metrics(args.metrics1)
-    df2 = load_metrics(args.metrics2)
+def merged_from_files(args):
+    columns = ['task_id'] + args.fields
+    df1 = load_metrics(args.metrics1, columns=available_columns(args.metrics1, columns))
+    df2 = load_metrics(args.metrics2, columns=available_columns(args.metrics2, columns))
 
     for field in args.fields:
         if field not in df1.columns or field not in df2.columns:
@@ -89,13 +106,88 @@ def main():
         m2 = df2[['task_id', field]].copy()
         m2.rename(columns={field: f'{field}_{args.label2}'}, inplace=True)
 
-        merged = pd.merge(m1, m2, on='task_id', how='inner')
+        yield field, pd.merge(m1, m2, on='task_id', how='inner')
 
-        plot_grouped_bar(merged, args.label1, args.label2, field, args.output_dir)
-        plot_scatter(merged, args.label1, args.label2, field, args.output_dir)
-        plot_diff_histogram(merged, args.label1, args.label2, field, args.output_dir)
+
+def merged_from_index(args):
+    conn = connect(Path(args.index))
+    known = {label for label, in conn.execute("SELECT label FROM runs")}
+    missing = [label for label in args.runs if label not in known]
+    if missing:
+        raise SystemExit(f"Runs not in {args.index}: {', '.join(missing)} (index them with run_index.py)")
+
+    for field in args.fields:
+        table = task_field_table(conn, field, args.runs)
+        if len(table.columns) < len(args.runs):
+            print(f"Warning: Field '{field}' not found in all runs, skipping.")
+            continue
+        # Only tasks present in every run are compared, as with the inner merge of two files
+        table = table.dropna(how='any')
+        table.columns = [f'{field}_{label}' for label in table.columns]
+        yield field, table.reset_index()
+    conn.close()
+
+
+def run_correlations(args):
+    # Per-candidate correlations of each run, from one query over the index instead of one merge per run
+    conn = connect(Path(args.index))
+    candidates = candidate_table(conn, args.correlations, args.runs)
+    conn.close()
+    tables = []
+    for label in args.runs:
+        table = candidate_correlations(candidates[candidates['label'] == label], args.correlations,
+                                       resamples=args.resamples)
+        table.insert(0, 'run', label)
+        tables.append(table)
+    table = pd.concat(tables, ignore_index=True)
+    table.to_csv(os.path.join(args.output_dir, 'candidate_correlations_by_run.csv'), index=False)
+    print(table.to_string(index=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare HumanEval metrics of two files or of any number of indexed runs and visualize specified metrics"
+    )
+    parser.add_argument('--metrics1', help='First metrics JSONL or Parquet file')
+    parser.add_argument('--metrics2', help='Second metrics JSONL or Parquet file')
+    parser.add_argument('--label1',   help='Label for first run (used in legends)')
+    parser.add_argument('--label2',   help='Label for second run')
+    parser.add_argument('--index',    help='SQLite index built by run_index.py, used instead of metrics files')
+    parser.add_argument('--runs',     nargs='+', metavar='LABEL', help='Labels (run directory names) of indexed runs')
+    parser.add_argument('--fields',   nargs='+', default=[],
+                        help='List of metric fields (exact column names) to compare')
+    parser.add_argument('--correlations', nargs='+', metavar='METRIC',
+                        help='Correlate these candidate metrics with passing in each indexed run (needs --index)')
+    parser.add_argument('--resamples', type=int, default=2000, help='Bootstrap resamples and permutations')
+    parser.add_argument('--output-dir', default='compared_visuals', help='Directory to save plots')
+
+    args = parser.parse_args()
+    if not args.fields and not args.correlations:
+        parser.error('nothing to compare, give --fields and/or --correlations')
+    if args.correlations and args.index is None:
+        parser.error('--correlations requires --index')
+    if args.index is not None:
+        if not args.runs or len(args.runs) < 2:
+            parser.error('--index requires at least two --runs')
+        labels, merged_fields = args.runs, merged_from_index(args)
+    else:
+        if None in (args.metrics1, args.metrics2, args.label1, args.label2):
+            parser.error('--metrics1, --metrics2, --label1 and --label2 are required without --index')
+        labels, merged_fields = [args.label1, args.label2], merged_from_files(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for field, merged in merged_fields:
+        plot_grouped_bar(merged, labels, field, args.output_dir)
+        for label1, label2 in combinations(labels, 2):
+            plot_scatter(merged, label1, label2, field, args.output_dir)
+            plot_diff_histogram(merged, label1, label2, field, args.output_dir)
+        if len(labels) > 2:
+            plot_run_correlation(merged, labels, field, args.output_dir)
         print(f"Generated visuals for field '{field}'")
 
+    if args.correlations:
+        run_correlations(args)
+
     print(f"Comparative visualizations saved to {args.output_dir}")
 
 if __name__ == "__main__":
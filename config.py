@@ -1,8 +1,8 @@
 import argparse
 import json
 import os
-from typing import List
-from pydantic import BaseModel
+from typing import List, Literal, Optional
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class ModelConfig(BaseModel):
@@ -16,10 +16,55 @@ class DataConfig(BaseModel):
 
 
 class EvaluationConfig(BaseModel):
+    # CLI overrides are assigned after loading, so they are validated too
+    model_config = ConfigDict(validate_assignment=True)
+
     tasks: int
     candidates: int
-    k: int
+    k: int = Field(ge=1)
     metrics: List[str]
+    timeout: float = 10
+    workers: Optional[int] = None
+    max_jobs_per_worker: Optional[int] = 500
+    metric_timeout: float = 120
+    parquet: bool = True
+    test_mode: Literal["check", "asserts"] = "check"
+    test_timeout: float = 3
+    run_all_tests: bool = False
+    sandbox: bool = True
+    memory_limit_mb: Optional[int] = 4096
+    cpu_limit: Optional[float] = 10
+    open_files_limit: Optional[int] = 256
+    dedup: bool = True
+    pairwise_metrics: List[str] = ["gestalt_similarity", "cfg_similarity"]
+
+
+class GenerationConfig(BaseModel):
+    concurrency: int = 1
+    max_concurrency: int = 16
+    max_retries: int = 5
+    backoff: float = 1.0
+    cache_path: Optional[str] = "cache/llm_responses"
+    cache_max_mb: int = 1024
+    backend: Literal["grazie", "openai"] = "grazie"
+    base_url: Optional[str] = None
+    max_connections: int = 16
+    request_timeout: float = 300
+    stream: bool = True
+    early_stop: bool = True
+    batch_samples: bool = True
+    extract_code: bool = True
+
+
+class PipelineConfig(BaseModel):
+    enabled: bool = False
+    queue_size: int = 64
+
+
+class ProfilingConfig(BaseModel):
+    enabled: bool = True
+    cprofile: bool = False
+    py_spy: bool = False
 
 
 class Config(BaseModel):
@@ -27,9 +72,17 @@ class Config(BaseModel):
     model: ModelConfig
     data: DataConfig
     evaluation: EvaluationConfig
+    generation: GenerationConfig = GenerationConfig()
+    pipeline: PipelineConfig = PipelineConfig()
+    profiling: ProfilingConfig = ProfilingConfig()
 
     def get_label(self) -> str:
-        return f"{self.model.llm}-{self.data.dataset}-{self.evaluation.tasks}-{self.evaluation.candidates}-{self.evaluation.k}"
+        # k is only picked at analysis time, so runs differing in k share their directory
+        return f"{self.model.llm}-{self.data.dataset}-{self.evaluation.tasks}-{self.evaluation.candidates}"
+
+    def get_legacy_label(self) -> str:
+        # Directory name of runs from before k was dropped from the label
+        return f"{self.get_label()}-{self.evaluation.k}"
 
 
 def load_config(path: str) -> Config:
@@ -54,6 +107,34 @@ def merge_args_with_config(args, config: Config) -> Config:
         config.evaluation.candidates = args.num_candidates
     if args.k is not None:
         config.evaluation.k = args.k
+    if args.concurrency is not None:
+        config.generation.concurrency = args.concurrency
+    if args.no_cache:
+        config.generation.cache_path = None
+    if args.backend is not None:
+        config.generation.backend = args.backend
+    if args.base_url is not None:
+        config.generation.base_url = args.base_url
+    if args.no_early_stop:
+        config.generation.early_stop = False
+    if args.no_batch_samples:
+        config.generation.batch_samples = False
+    if args.no_extract:
+        config.generation.extract_code = False
+    if args.workers is not None:
+        config.evaluation.workers = args.workers
+    if args.test_mode is not None:
+        config.evaluation.test_mode = args.test_mode
+    if args.no_sandbox:
+        config.evaluation.sandbox = False
+    if args.no_parquet:
+        config.evaluation.parquet = False
+    if args.pipelined:
+        config.pipeline.enabled = True
+    if args.cprofile:
+        config.profiling.cprofile = True
+    if args.py_spy:
+        config.profiling.py_spy = True
     return config
 
 
@@ -72,6 +153,29 @@ def parse_cli() -> argparse.Namespace:
     parser.add_argument("--max_tasks", type=int, help="Number of tasks to run")
     parser.add_argument("--num_candidates", type=int, help="Number of candidate solutions per task")
     parser.add_argument("--k", type=int, help="pass@k value for evaluation")
+    parser.add_argument("--no_cache", action="store_true", help="Do not read or store LLM responses in the cache")
+    parser.add_argument("--backend", choices=["grazie", "openai"], help="LLM backend to generate solutions with")
+    parser.add_argument("--base_url", help="URL of an OpenAI-compatible API for the openai backend")
+    parser.add_argument("--no_early_stop", action="store_true",
+                        help="Read responses to the end instead of stopping after the generated function")
+    parser.add_argument("--no_batch_samples", action="store_true",
+                        help="Request every candidate separately even if the backend can sample several per request")
+    parser.add_argument("--no_extract", action="store_true",
+                        help="Run and measure the responses as they are, without extracting the code from them")
+    parser.add_argument("--workers", type=int, help="Number of sandbox worker processes (defaults to CPU count)")
+    parser.add_argument("--test_mode", choices=["check", "asserts"],
+                        help="Run check() as a whole or every assertion on its own time budget")
+    parser.add_argument("--no_sandbox", action="store_true",
+                        help="Run candidates without resource limits and guards (e.g. to debug the evaluation)")
+    parser.add_argument("--no_parquet", action="store_true",
+                        help="Do not write the Parquet copies of the metrics next to metrics.jsonl")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Evaluate and measure every candidate as soon as it is generated")
+    parser.add_argument("--cprofile", action="store_true",
+                        help="Profile the main process with cProfile into profile.prof in the run directory")
+    parser.add_argument("--py_spy", action="store_true",
+                        help="Sample the run and its workers with py-spy into py-spy.json in the run directory")
+    parser.add_argument("--concurrency", type=int, help="Initial number of in-flight LLM requests during generation")
 
     parsed = parser.parse_args()
     return parsed
@@ -1,46 +1,22 @@
 import json
-import multiprocessing
-from math import comb
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 
-from grazie.api.client.profiles import Profile
-from grazie.api.client.endpoints import GrazieApiGatewayUrls
-from grazie.api.client.gateway import AuthType, GrazieApiGatewayClient, GrazieAgent
-from grazie.api.client.chat.prompt import ChatPrompt
-
+from assert_runner import run_test_cases
+from checkpoints import AtomicJsonlWriter, Checkpoint, checkpoint_path, record_key
+from code_cache import candidate_namespace, test_code
 from config import Config
-from utils import load_tasks
-
-LLM_USED = {"claude-3.7": Profile.ANTHROPIC_CLAUDE_37_SONNET,
-            "claude-3.5-sonnet": Profile.ANTHROPIC_CLAUDE_35_SONNET,
-            "gpt-4": Profile.OPENAI_GPT_4,
-            "gpt-4o-mini": Profile.OPENAI_GPT_4_O_MINI,
-            "claude-3h": Profile.ANTHROPIC_CLAUDE_3_HAIKU,
-            }
-
-class LLMProvider:
-    def __init__(self, token, config):
-        url = url = GrazieApiGatewayUrls.PRODUCTION if config.is_prod else GrazieApiGatewayUrls.STAGING
-        self.profile = LLM_USED[config.model.llm]
-        self.prompt = config.model.prompt
-        self.client = GrazieApiGatewayClient(
-            url=url,
-            grazie_jwt_token=token,
-            auth_type=AuthType.USER,
-            grazie_agent=GrazieAgent(name="grazie-api-gateway-client-heval-test", version="dev")
-        )
-
-    def make_call(self, task):
-        chat = (
-            ChatPrompt()
-            .add_system(self.prompt)
-            .add_user(task)
-        )
-        response = self.client.chat(
-            chat=chat,
-            profile=self.profile
-        )
-        return response.content
+from extraction import extract_solution
+from llm_provider import LLMProvider
+import profiling
+from pass_at_k import aggregate_curve, at_k, pass_at_k_curve
+from sandbox import USAGE_FIELDS, run_sandboxed, sandbox_initializer
+from scheduling import AdaptiveLimiter, call_with_retries
+from utils import OrderedLookup, group_by_task, iter_jsonl, iter_tasks, load_tasks, solution_hash
+from worker_pool import OrderedResults, WorkerPool, run_job
 
 
 def run_some_task(i, path, provider):
@@ -106,124 +82,301 @@ def evaluate_some(i, provider, dataset_path="HumanEval.jsonl"):
     }
 
 
+def generation_threads(config: Config):
+    # The limiter decides how many of these threads actually have a request in flight
+    return max(1, config.generation.max_concurrency, config.generation.concurrency)
+
+
+def generation_batches(provider: LLMProvider, cands):
+    # One request for all missing candidates of a task when the backend samples several per call
+    size = max(1, len(cands)) if provider.batches_samples else 1
+    return [cands[i:i + size] for i in range(0, len(cands), size)]
+
+
+def solution_generator(config: Config, provider: LLMProvider):
+    generation = config.generation
+    limiter = AdaptiveLimiter(generation.concurrency, generation.max_concurrency)
+
+    # Returns (candidate index, record or the error that candidate failed with) for every candidate of the batch
+    def generate(task, cands):
+        stats = {}
+        started = time.perf_counter()
+        try:
+            solutions = call_with_retries(
+                lambda: provider.make_calls(task["prompt"], cands, stats, task["entry_point"]), limiter,
+                generation.max_retries, generation.backoff, stats)
+        except Exception as e:
+            profiling.record("generation", task_id=task["task_id"], candidates=cands, status="error",
+                             wall=time.perf_counter() - started, **stats)
+            return [(cand, e) for cand in cands]
+        profiling.record("generation", task_id=task["task_id"], candidates=cands, status="ok",
+                         wall=time.perf_counter() - started, response_chars=sum(map(len, solutions)), **stats)
+        outcomes = []
+        for cand, solution in zip(cands, solutions):
+            if not solution.strip():
+                outcomes.append((cand, ValueError("No response.")))
+                continue
+            record = {
+                "task_id": task["task_id"],
+                "entry_point": task["entry_point"],
+                "solution": solution,
+                "candidate_index": cand
+            }
+            if generation.extract_code:
+                # The cleaned code is what gets run and measured, the response is kept as it came
+                code, error = extract_solution(solution, task["prompt"], task["entry_point"])
+                record.update(solution=code, raw_solution=solution, extraction_error=error)
+            outcomes.append((cand, record))
+        return outcomes
+
+    return generate
+
+
 def run_all_tasks(config: Config, provider: LLMProvider, output_path: Path):
     max_index = config.evaluation.tasks
     num_candidates = config.evaluation.candidates
-    tasks = load_tasks(config.data.dataset_path)
-    with output_path.open(mode='w') as out_file:
-        for i, task in enumerate(tasks):
-            if max_index is not None and i >= max_index:
-                break
-
+    max_workers = generation_threads(config)
+    generate = solution_generator(config, provider)
+
+    checkpoint = Checkpoint(checkpoint_path(output_path))
+    keys = [(task["task_id"], cand) for task in iter_tasks(config.data.dataset_path, max_index)
+            for cand in range(num_candidates)]
+    print(f"{sum(key in checkpoint for key in keys)} of {len(keys)} candidates already generated")
+    jobs = ((i, task, batch) for i, task in enumerate(iter_tasks(config.data.dataset_path, max_index))
+            for batch in generation_batches(provider, [cand for cand in range(num_candidates)
+                                                       if (task["task_id"], cand) not in checkpoint]))
+
+    with checkpoint, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Only a bounded window of requests is submitted ahead of the one being written
+        in_flight = deque()
+
+        def submit_next():
+            job = next(jobs, None)
+            if job is not None:
+                in_flight.append((job, executor.submit(generate, job[1], job[2])))
+
+        for _ in range(2 * max_workers):
+            submit_next()
+        # Collect in submission order so the output is stable regardless of completion order
+        current_task_id = None
+        while in_flight:
+            (i, task, _), future = in_flight.popleft()
             task_id = task["task_id"]
-            prompt = task["prompt"]
-            entry_point = task["entry_point"]
-
-            print(f"\n=== Task {i} | ID: {task_id} ===")
-            # Generate multiple candidates per task
-            for cand in range(num_candidates):
-                try:
-                    solution = provider.make_call(prompt)
-                    if not solution.strip():
-                        raise ValueError("No response.")
+            if task_id != current_task_id:
+                current_task_id = task_id
+                print(f"\n=== Task {i} | ID: {task_id} ===")
+            for cand, outcome in future.result():
+                if isinstance(outcome, Exception):
+                    print(f"Error in task {task_id}, candidate {cand}: {outcome}")
+                else:
+                    checkpoint.add(outcome)
                     print(f"Candidate {cand} solution generated.")
-                    record = {
-                        "task_id": task_id,
-                        "entry_point": entry_point,
-                        "solution": solution,
-                        "candidate_index": cand
-                    }
-                    out_file.write(json.dumps(record) + "\n")
-                except Exception as e:
-                    print(f"Error in task {task_id}, candidate {cand}: {e}")
-
+            submit_next()
 
-def compute_pass(n, c, k):
-    k = min(n, k)
-    if n == 0 or c == 0:
-        return 0.0
-    return 1 - comb(n - c, k) / comb(n, k)
+        with AtomicJsonlWriter(output_path) as writer:
+            for key in keys:
+                record = checkpoint.get(key)
+                if record is not None:
+                    writer.write(record)
 
 
-def run_exec_in_thread(queue, full_code, test_code):
-    namespace = {}
-    try:
-        exec(full_code, namespace)
-        exec(test_code, namespace)
-        result = namespace["check"](namespace["candidate"])
-        queue.put(("pass", result))
-    except Exception as e:
-        queue.put(("fail", str(e)))
+# Runs inside a sandbox worker; exceptions are reported back by the pool as an "error" status.
+# Only the candidate is compiled per call, the task's prompt and tests come from the worker's code cache.
+def run_candidate(prompt, solution, entry_point, test_source):
+    namespace = candidate_namespace(prompt, solution, entry_point)
+    exec(test_code(test_source), namespace)
+    return namespace["check"](namespace["candidate"])
 
-def run_exec(full_code, test_code, timeout):
-    queue = multiprocessing.Queue()
-    p = multiprocessing.Process(target=run_exec_in_thread, args=(queue, full_code, test_code))
-    p.start()
-    p.join(timeout)
 
-    if p.is_alive():
-        p.terminate()
-        p.join()
-        return False, "Timeout"
+def evaluation_job(config: Config, task, solution):
+    evaluation = config.evaluation
+    candidate = task["prompt"], solution, task["entry_point"], task["test"]
+    if evaluation.test_mode == "asserts":
+        job = run_test_cases, (*candidate, evaluation.test_timeout, evaluation.run_all_tests)
+    else:
+        job = run_candidate, candidate
+    if evaluation.sandbox:
+        return run_sandboxed, (*job, evaluation.cpu_limit)
+    return job
+
+
+def evaluation_pool(config: Config):
+    evaluation = config.evaluation
+    initializer = sandbox_initializer(evaluation.memory_limit_mb, evaluation.open_files_limit) \
+        if evaluation.sandbox else None
+    return WorkerPool(processes=evaluation.workers, timeout=evaluation.timeout,
+                      max_jobs_per_worker=evaluation.max_jobs_per_worker, initializer=initializer)
+
+
+def is_evaluated(checkpoint, key, test_mode):
+    # Outcomes of the other test mode do not count, e.g. they lack the per-test records
+    record = checkpoint.get(key)
+    return record is not None and record.get("test_mode", "check") == test_mode
+
+
+def evaluation_record(key, status, result, test_mode, digest, duration=None):
+    # duration is the pool's round trip of the candidate, usage the part of it spent running in the sandbox
+    task_id, idx = key
+    record = {"task_id": task_id, "candidate_index": idx, "test_mode": test_mode, "solution_hash": digest}
+    usage = {}
+    if status == "ok" and isinstance(result, dict) and result.get("sandboxed"):
+        usage = result["usage"]
+        record.update(usage)
+        status, result = result["status"], result["result"]
+    profiling.record("evaluation", task_id=task_id, candidate_index=idx, status=status, wall=duration,
+                     sandbox_wall=usage.get("wall_time"), sandbox_cpu=usage.get("cpu_time"),
+                     peak_rss_mb=usage.get("peak_rss_mb"))
+    if status == "ok" and isinstance(result, dict):  # run_test_cases reports on every test
+        record.update(passed=result["passed"], message=result["error"], tests=result["tests"])
+    else:
+        record.update(passed=status == "ok", message=None if status == "ok" else result)
+    if record["passed"]:
+        print(f"Task {task_id} candidate {idx} PASS")
+    else:
+        print(f"Task {task_id} candidate {idx} FAIL: {record['message']}")
+    return record
 
-    status, result = queue.get()
-    return status == "pass", result
 
-def evaluate_all(config: Config, solutions_path: Path, output_path: Path):
-    tasks = {task["task_id"]: task for task in load_tasks(config.data.dataset_path)}
-    grouped_solutions = {}
+def rejected_record(record, key, test_mode, digest):
+    # Candidates whose code does not even compile fail right away instead of taking a sandbox slot
+    if not record.get("extraction_error"):
+        return None
+    return evaluation_record(key, "error", record["extraction_error"], test_mode, digest, duration=0.0)
+
+
+def duplicate_record(record, key):
+    # Outcome of a candidate whose normalized solution was already run for the same task
+    duplicate = dict(record, task_id=key[0], candidate_index=key[1], duplicate_of=record["candidate_index"])
+    print(f"Task {key[0]} candidate {key[1]} {'PASS' if record['passed'] else 'FAIL'} "
+          f"(duplicate of candidate {record['candidate_index']})")
+    return duplicate
+
+
+# Runs every distinct solution once per run key and journals the outcome of each candidate: reused from the
+# checkpoint, copied from the candidate that ran the same solution, failed right away when the code does not
+# compile, or recorded when its job returns
+class CandidateRuns:
+    def __init__(self, config: Config, checkpoint):
+        self.config = config
+        self.checkpoint = checkpoint
+        self.test_mode = config.evaluation.test_mode
+        # Run key -> the candidate whose outcome it has, or the candidates waiting for the job running it
+        self.finished = {}
+        self.running = {}
+
+    def reuse(self, record):
+        # True if the candidate's outcome is already checkpointed; later duplicates copy it instead of running
+        key = record_key(record)
+        if not is_evaluated(self.checkpoint, key, self.test_mode):
+            return False
+        self.finished.setdefault(run_key(self.config, key, solution_hash(record["solution"])), key)
+        return True
+
+    def admit(self, record):
+        # None once the candidate's outcome is journaled, otherwise (run key, digest, whether a job has to be
+        # started for it) while it waits for a job
+        if self.reuse(record):
+            return None
+        key = record_key(record)
+        digest = solution_hash(record["solution"])
+        rkey = run_key(self.config, key, digest)
+        if rkey in self.finished:
+            self.checkpoint.add(duplicate_record(self.checkpoint.get(self.finished[rkey]), key))
+            return None
+        if rkey in self.running:
+            self.running[rkey].append(record)
+            return rkey, digest, False
+        rejected = rejected_record(record, key, self.test_mode, digest)
+        if rejected is not None:
+            self.checkpoint.add(rejected)
+            self.finished[rkey] = key
+            return None
+        self.running[rkey] = [record]
+        return rkey, digest, True
+
+    def complete(self, rkey, digest, status, result, duration):
+        # Journals a job's outcome for every candidate that waited for it and returns their records
+        records = self.running.pop(rkey)
+        key = record_key(records[0])
+        outcome = evaluation_record(key, status, result, self.test_mode, digest, duration)
+        self.checkpoint.add(outcome)
+        for record in records[1:]:
+            self.checkpoint.add(duplicate_record(outcome, record_key(record)))
+        self.finished[rkey] = key
+        return records
+
+
+def run_key(config: Config, key, digest):
+    # Candidates sharing a run key are run once; without deduplication every candidate is its own run
+    return (key[0], digest) if config.evaluation.dedup else key
 
-    with solutions_path.open() as f:
-        for line in f:
-            record = json.loads(line)
-            grouped_solutions.setdefault(record["task_id"], []).append(record["solution"])
 
-    max_tasks = config.evaluation.tasks
+def evaluate_all(config: Config, solutions_path: Path, output_path: Path):
     k = config.evaluation.k
-
-    task_ids = list(grouped_solutions.keys())
-    if max_tasks is not None:
-        task_ids = task_ids[:max_tasks]
-
-    results = []
-    for task_id in task_ids:
-        task = tasks[task_id]
-        prompt = task["prompt"]
-        entry_point = task["entry_point"]
-        test_code = task["test"]
-
-        solutions = grouped_solutions[task_id]
-        n = len(solutions)
-        c = 0
-        passes = []
-
-        for idx, solution in enumerate(solutions):
-            full_code = f"{prompt.strip()}\n{solution.strip()}\ncandidate = {entry_point}"
-            status, message = run_exec(full_code, test_code, timeout=10)
-            passes.append(status)
-            if status:
-                c += 1
-                print(f"Task {task_id} candidate {idx} PASS")
-            else:
-                print(f"Task {task_id} candidate {idx} FAIL: {message}")
-
-        pass_at_k = compute_pass(n, c, k)
-        print(f"\nTask {task_id}: n = {n}, correct = {c}, pass@{k} = {pass_at_k:.4f}\n")
-        results.append({
-            "task_id": task_id,
+    test_mode = config.evaluation.test_mode
+    tasks = OrderedLookup(iter_tasks(config.data.dataset_path))
+    groups = islice(group_by_task(iter_jsonl(solutions_path)), config.evaluation.tasks)
+    checkpoint = Checkpoint(checkpoint_path(output_path))
+    runs = CandidateRuns(config, checkpoint)
+    curves, ses = [], []
+
+    def write_result(writer, state):
+        outcomes = checkpoint.ordered(state["keys"])
+        passes = [outcome["passed"] for outcome in outcomes]
+        n = len(passes)
+        c = sum(passes)
+
+        # The whole curve is stored, so any k can be picked at analysis time
+        curve, se = pass_at_k_curve(passes)
+        pass_at_configured_k = at_k(curve, k)
+        print(f"\nTask {state['task_id']}: n = {n}, correct = {c}, pass@{k} = {pass_at_configured_k:.4f}\n")
+        result = {
+            "task_id": state["task_id"],
             "total_candidates": n,
             "correct_candidates": c,
-            "pass@k": pass_at_k,
+            "pass@k": pass_at_configured_k,
             "passes": passes,
-        })
-
-    if results:
-        avg_pass_at_k = sum(r["pass@k"] for r in results) / len(results)
-        print(f"Average pass@{k}: {avg_pass_at_k:.4f}")
+            "pass@k_curve": curve.tolist(),
+            "pass@k_se": se.tolist(),
+        }
+        if test_mode == "asserts":
+            # A finer signal than pass/fail; with early exit tests after the first failure are not run
+            result["tests_passed"] = [sum(test["passed"] for test in outcome.get("tests", []))
+                                      for outcome in outcomes]
+            result["tests_run"] = [len(outcome.get("tests", [])) for outcome in outcomes]
+        # Sandbox usage of every candidate, None for candidates that were not run in the sandbox
+        for field in USAGE_FIELDS:
+            result[field] = [outcome.get(field) for outcome in outcomes]
+        writer.write(result)
+        curves.append(curve)
+        ses.append(se)
+
+    def jobs(results):
+        for task_id, solutions in groups:
+            task = tasks.get(task_id)
+            # Checkpointed outcomes are taken first, so no candidate reruns a solution that already has one
+            for record in solutions:
+                runs.reuse(record)
+            waiting = [(record, runs.admit(record)) for record in solutions]
+            state = {"task_id": task_id, "keys": [record_key(record) for record in solutions]}
+            results.start(state, sum(run is not None for _, run in waiting))
+            for record, run in waiting:
+                if run is not None and run[2]:
+                    results.submit((run[0], run[1], state))
+                    yield evaluation_job(config, task, record["solution"])
+
+    with checkpoint, AtomicJsonlWriter(output_path) as writer, evaluation_pool(config) as pool:
+        results = OrderedResults(lambda state: write_result(writer, state))
+        for job_id, status, result in pool.imap_unordered(run_job, jobs(results)):
+            rkey, digest, state = results.take(job_id)
+            results.done(state, len(runs.complete(rkey, digest, status, result, pool.last_duration)))
+
+    if curves:
+        summary = aggregate_curve(curves, ses)
+        with output_path.with_name("pass_at_k.json").open("w") as f:
+            json.dump(summary, f, indent=2)
+        i = min(k, len(summary["pass@k"])) - 1
+        print(f"Average pass@{k}: {summary['pass@k'][i]:.4f} "
+              f"(SE over tasks {summary['se'][i]:.4f}, SE from candidate sampling {summary['se_sampling'][i]:.4f})")
     else:
         print("No tasks were evaluated.")
-
-    with open(output_path, 'w') as f:
-        for result in results:
-            f.write(json.dumps(result) + "\n")
-    return results
@@ -0,0 +1,226 @@
+import ast
+import re
+
+from code_cache import compile_candidate
+
+# Top-level lines that continue the code rather than end it, although they do not parse on their own
+CONTINUATIONS = re.compile(r"(else|elif|except|finally|case|try)\b|@")
+FENCE_LINE = re.compile(r"^[ \t]*```", re.M)
+# Top-level statements of a response that exercise the solution instead of defining it
+SCAFFOLDING = (ast.Expr, ast.Assert)
+
+
+def _parse(text):
+    try:
+        return ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+
+
+def is_code_line(line):
+    # Blank, indented and comment lines, lines that parse on their own and headers of compound statements
+    # (def, class, if, for, with, ...), which parse once they get a body
+    if not line.strip() or line[0].isspace() or CONTINUATIONS.match(line):
+        return True
+    return _parse(line) is not None or _parse(line + "\n    pass") is not None
+
+
+def starts_code(line):
+    # A top-level line that begins code: a statement other than a bare expression, since a line of prose such as
+    # "Explanation" parses as a name, or a compound statement header or decorator
+    if not line.strip() or line[0].isspace() or line.startswith("#"):
+        return False
+    if line.startswith("@"):
+        return True
+    module = _parse(line)
+    if module is None:
+        return _parse(line + "\n    pass") is not None
+    return bool(module.body) and not isinstance(module.body[0], ast.Expr)
+
+
+def defines(module, name):
+    # Without a name, any function counts
+    for node in module.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and \
+                (node.name == name or name is None and not isinstance(node, ast.ClassDef)):
+            return True
+        if name is not None and isinstance(node, ast.Assign) and \
+                any(isinstance(target, ast.Name) and target.id == name for target in node.targets):
+            return True
+    return False
+
+
+def defines_entry_point(code, entry_point):
+    module = _parse(code)
+    return module is not None and defines(module, entry_point)
+
+
+class CodeEndDetector:
+    # Fed with the chunks of a streamed response, tells where the code ends once the response holds a complete
+    # definition of the entry point followed by something that is not code: the closing fence of the code block
+    # defining it or a line of prose. Everything after that point is explanation the model appends, so the stream
+    # can be cut off there. Helpers after the entry point and blocks before it do not end the code.
+    def __init__(self, entry_point=None):
+        self.entry_point = entry_point
+        self.text = ""
+        self.scanned = 0
+        # Start of the current code region, or None while in prose
+        self.code_start = None
+        self.fenced = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        while True:
+            line_end = self.text.find("\n", self.scanned)
+            if line_end < 0:
+                return None
+            start, self.scanned = self.scanned, line_end + 1
+            end = self._line(start, self.text[start:line_end])
+            if end is not None:
+                return end
+
+    def _line(self, start, line):
+        if FENCE_LINE.match(line):
+            if not self.fenced:
+                self.code_start, self.fenced = self.scanned, True
+                return None
+            self.fenced = False
+            if defines_entry_point(self.text[self.code_start:start], self.entry_point):
+                return self.scanned
+            self.code_start = None
+            return None
+        if self.fenced:
+            return None
+        if self.code_start is None:
+            if starts_code(line):
+                self.code_start = start
+            return None
+        if is_code_line(line):
+            return None
+        # Prose after the code; ends it only if the code before defines the entry point
+        if defines_entry_point(self.text[self.code_start:start], self.entry_point):
+            return start
+        self.code_start = None
+        return None
+
+
+def code_blocks(raw):
+    # Contents of the ``` fenced blocks of a response, the last one possibly unterminated (a cut-off stream)
+    blocks, block = [], None
+    for line in raw.splitlines(keepends=True):
+        if FENCE_LINE.match(line):
+            if block is None:
+                block = []
+            else:
+                blocks.append("".join(block))
+                block = None
+        elif block is not None:
+            block.append(line)
+    if block:
+        blocks.append("".join(block))
+    return blocks
+
+
+def _parsed_prefix(region):
+    # The longest prefix of a code region ending at a top-level line that parses, e.g. without a trailing line of
+    # prose that happens to look like code
+    lines = region.splitlines(keepends=True)
+    for end in range(len(lines), 0, -1):
+        if end < len(lines) and lines[end][:1].isspace():
+            continue
+        prefix = "".join(lines[:end])
+        if _parse(prefix) is not None:
+            return prefix
+    return None
+
+
+def code_regions(text):
+    # Runs of code lines between the lines of prose of an unfenced response
+    regions, region = [], None
+    for line in text.splitlines(keepends=True):
+        if region is None:
+            if starts_code(line):
+                region = [line]
+        elif is_code_line(line):
+            region.append(line)
+        else:
+            regions.append("".join(region))
+            region = None
+    if region is not None:
+        regions.append("".join(region))
+    return regions
+
+
+def unfenced_code(raw, entry_point):
+    # The code regions of the response up to the first fence with the prose between them dropped, as long as they
+    # define the entry point together; otherwise everything from the first code line on, prose included, so code
+    # that cannot run fails visibly instead of silently losing a part. A response without any code line (e.g. just
+    # the function body) is taken as it is.
+    fence = FENCE_LINE.search(raw)
+    text = raw if fence is None else raw[:fence.start()]
+    regions = code_regions(text)
+    if not regions:
+        return text
+    code = "".join(prefix for prefix in map(_parsed_prefix, regions) if prefix is not None)
+    if defines_entry_point(code, entry_point):
+        return code
+    return text[text.index(regions[0]):]
+
+
+def _entry_point_pattern(entry_point):
+    return re.compile(rf"^\s*(async\s+)?def\s+{re.escape(entry_point)}\b", re.M)
+
+
+def is_main_guard(node):
+    return isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and \
+        isinstance(node.test.left, ast.Name) and node.test.left.id == "__name__"
+
+
+def strip_scaffolding(code, module):
+    # Example calls, prints, asserts and __main__ blocks after the definitions would run (and may fail) together
+    # with the tests, so only the definitions, imports and assignments are kept. Docstrings stay.
+    dropped = set()
+    for i, node in enumerate(module.body):
+        docstring = i == 0 and isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant)
+        if (isinstance(node, SCAFFOLDING) and not docstring) or is_main_guard(node):
+            dropped.update(range(node.lineno, node.end_lineno + 1))
+    if not dropped:
+        return code
+    return "".join(line for number, line in enumerate(code.splitlines(keepends=True), 1) if number not in dropped)
+
+
+def is_definitions(code):
+    # Code that only defines things (imports, functions, classes, constants), e.g. a block of helpers
+    module = _parse(code)
+    return module is not None and bool(module.body) and \
+        all(not isinstance(node, SCAFFOLDING) and not is_main_guard(node) for node in module.body)
+
+
+def extract_solution(raw, prompt, entry_point):
+    # (code, error) of a response: the code block defining the entry point (with the blocks of helpers before it),
+    # or the code between the prose, without the scaffolding after it. error is None for code that compiles the way
+    # the candidate is run, otherwise the reason it cannot run at all, so it fails without taking a sandbox slot.
+    blocks = code_blocks(raw)
+    pattern = _entry_point_pattern(entry_point)
+    chosen = next((i for i, block in enumerate(blocks) if pattern.search(block)), None)
+    if chosen is not None:
+        code = "\n".join([block for block in blocks[:chosen] if is_definitions(block)] + [blocks[chosen]])
+    else:
+        # Responses also close a block they never opened, with the code before the first fence
+        code = unfenced_code(raw, entry_point)
+        if blocks and not pattern.search(code):
+            code = blocks[0]
+    if not code.strip():
+        return "", "No code in the response"
+    try:
+        module = ast.parse(code)
+    except SyntaxError:
+        module = None  # e.g. a function body, which only compiles after the prompt
+    if module is not None and defines(module, entry_point):
+        code = strip_scaffolding(code, module)
+    code = code.strip("\n") + "\n"
+    try:
+        compile_candidate(prompt, code, entry_point)
+    except (SyntaxError, ValueError) as e:  # ValueError for null bytes
+        return code, f"{type(e).__name__}: {e}"
+    return code, None
@@ -1,34 +1,76 @@
+import hashlib
+import math
+import sys
+import time
+from array import array
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from textwrap import dedent
 
 from py2cfg import CFGBuilder
 import networkx as nx
+import numpy as np
+from scipy.optimize import linear_sum_assignment
 
+from utils import normalize_source
 
-def walk_cfg(current_graph, used, cfg_node, nid_map):
-    if cfg_node.id not in nid_map:
-        nid_map[cfg_node.id] = len(nid_map)
-    nid = nid_map[cfg_node.id]
-    while nid >= len(used):
-        used.append(False)
-    used[nid] = True
-    for link in cfg_node.exits:
-        next = link.target
-        if next.id not in nid_map:
-            nid_map[next.id] = len(nid_map)
-        next_id = nid_map[next.id]
-        current_graph.append((nid, next_id))
-        if next_id >= len(used) or not used[next_id]:
-            walk_cfg(current_graph, used, next, nid_map)
+CFG_CACHE_SIZE = 4096
+# Exact GED only runs when the bounds leave more than this fraction of the normalization constant open
+GED_TOLERANCE = 0.05
+GED_TIMEOUT = 10
+WL_ITERATIONS = 3
+CFG_RECURSION_LIMIT = 20000
+# source key -> (edges, fingerprint), or the error message for code that could not be turned into a CFG
+_cfg_cache = OrderedDict()
+# (source key, source key) -> CFG similarity
+_similarity_cache = OrderedDict()
+
+
+# Raised by the CFG metrics for code that py2cfg cannot turn into a CFG, so the candidate gets an error instead of a
+# value that looks like a real triviality or similarity
+class CFGParseError(ValueError):
+    pass
+
+
+def walk_cfg(entry_block):
+    # Depth-first walk over the blocks reachable from the entry, numbering blocks in discovery order (the entry is 0)
+    # and keeping every exit of every reached block. The recursion is replaced by a stack of exit iterators, so deeply
+    # nested or very long code does not hit the recursion limit.
+    nid_map = {entry_block.id: 0}
+    sources, targets = array("i"), array("i")
+    stack = [(0, iter(entry_block.exits))]
+    while stack:
+        nid, exits = stack[-1]
+        link = next(exits, None)
+        if link is None:
+            stack.pop()
+            continue
+        block = link.target
+        next_id = nid_map.get(block.id)
+        if next_id is None:
+            next_id = nid_map[block.id] = len(nid_map)
+            stack.append((next_id, iter(block.exits)))
+        sources.append(nid)
+        targets.append(next_id)
+    return np.stack([np.asarray(sources, dtype=np.int32), np.asarray(targets, dtype=np.int32)], axis=1)
+
+
+@contextmanager
+def recursion_limit(limit):
+    previous = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, previous))
+    try:
+        yield
+    finally:
+        sys.setrecursionlimit(previous)
 
 
 def code_to_cfg_edges(text):
-    cfg = CFGBuilder().build_from_src('text', text)
-    a = cfg.entryblock
-    graph = []
-    used = []
-    nid_map = {}
-    walk_cfg(graph, used, a, nid_map)
-    return graph
+    # (n_edges, 2) int32 array of (source, target) block ids, parallel edges kept.
+    # py2cfg cleans up the CFG recursively, one frame per block on a path
+    with recursion_limit(CFG_RECURSION_LIMIT):
+        cfg = CFGBuilder().build_from_src('text', text)
+    return walk_cfg(cfg.entryblock)
 
 
 def preprocess(code):
@@ -37,34 +79,206 @@ def preprocess(code):
 
     return dedent(code)
 
+def source_key(text):
+    return hashlib.sha1(normalize_source(preprocess(text)).encode()).hexdigest()
+
+
+def _edge_counts(edges):
+    # Distinct (source, target) pairs and how many parallel edges each stands for
+    return np.unique(edges, axis=0, return_counts=True)
+
+
+def cfg_fingerprint(edges):
+    # Weisfeiler-Lehman hash of the CFG with the entry block marked, parallel edges folded into a count.
+    # Fingerprints are only compared within one process, so Python's hash of the label tuples is enough.
+    n = _node_count(edges)
+    pairs, counts = _edge_counts(edges)
+    labels = [1 if node == 0 else 0 for node in range(max(n, 1))]
+    for _ in range(WL_ITERATIONS):
+        outgoing = [[] for _ in labels]
+        incoming = [[] for _ in labels]
+        for (u, v), count in zip(pairs.tolist(), counts.tolist()):
+            outgoing[u].append((labels[v], count))
+            incoming[v].append((labels[u], count))
+        labels = [hash((labels[node], tuple(sorted(outgoing[node])), tuple(sorted(incoming[node]))))
+                  for node in range(len(labels))]
+    return hash((len(edges), tuple(sorted(labels))))
+
+
+def _remember(cache, key, value):
+    cache[key] = value
+    if len(cache) > CFG_CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+
+def cached_cfg(text):
+    # (edges, fingerprint) of the code's CFG; raises CFGParseError, also for code that failed before
+    key = source_key(text)
+    if key in _cfg_cache:
+        _cfg_cache.move_to_end(key)
+        entry = _cfg_cache[key]
+    else:
+        try:
+            edges = code_to_cfg_edges(normalize_source(preprocess(text)))
+            entry = edges, cfg_fingerprint(edges)
+        except Exception as e:  # SyntaxError, or AttributeError and friends from py2cfg on something weird
+            entry = f"{type(e).__name__}: {e}"
+        _remember(_cfg_cache, key, entry)
+    if isinstance(entry, str):
+        raise CFGParseError(entry)
+    return entry
+
+
+def _same_cfg(edges1, fingerprint1, edges2, fingerprint2):
+    if fingerprint1 != fingerprint2 or len(edges1) != len(edges2):
+        return False
+    # Equal WL hashes make isomorphism very likely but do not prove it
+    g1, g2 = nx.MultiDiGraph(edges1.tolist()), nx.MultiDiGraph(edges2.tolist())
+    g1.add_node(0)
+    g2.add_node(0)
+    nx.set_node_attributes(g1, {node: node == 0 for node in g1}, "entry")
+    nx.set_node_attributes(g2, {node: node == 0 for node in g2}, "entry")
+    return nx.is_isomorphic(g1, g2, node_match=lambda a, b: a["entry"] == b["entry"])
+
+
 def cfg_triviality(text):
-    text = preprocess(text)
-    try:
-        edges = code_to_cfg_edges(text)
-    except: # This is dumb
-        return -1.0
+    edges, _ = cached_cfg(text)
     return max(0.0, 1 - len(edges) / 4)
 
 
 def code_cfg_similarity(text1, text2):
-    text1 = preprocess(text1)
-    text2 = preprocess(text2)
-    try:
-        edges1 = code_to_cfg_edges(text1)
-        edges2 = code_to_cfg_edges(text2)
-    except: # SyntaxError or AttributeError since generated code is something weird, idk
-        return 0.0
+    pair_key = source_key(text1), source_key(text2)
+    if pair_key in _similarity_cache:
+        return _similarity_cache[pair_key]
+    return _remember(_similarity_cache, pair_key, _code_cfg_similarity(text1, text2, pair_key[0] == pair_key[1]))
+
+
+# Similarity value that remembers which tier of the similarity engine produced it: "trivial",
+# "isomorphic", "bounds" (lower == upper bound), "approximate" (bounds within tolerance), "exact" or "exact_timeout"
+class CFGSimilarity(float):
+    def __new__(cls, value, tier):
+        similarity = super().__new__(cls, value)
+        similarity.tier = tier
+        return similarity
+
+    def __reduce__(self):
+        return CFGSimilarity, (float(self), self.tier)
+
+
+def _degree_sequences(edges, n):
+    return np.bincount(edges[:, 0], minlength=n), np.bincount(edges[:, 1], minlength=n)
+
+
+def _sorted_l1(seq1, seq2):
+    size = max(len(seq1), len(seq2))
+    a = np.sort(np.pad(seq1, (0, size - len(seq1))))
+    b = np.sort(np.pad(seq2, (0, size - len(seq2))))
+    return int(np.abs(a - b).sum())
+
+
+def ged_lower_bound(edges1, n1, edges2, n2):
+    # Every node edit changes the node count by one; every edge edit changes the edge count by one and moves the
+    # sorted out- and in-degree sequences by at most one each, while node substitutions are free
+    out1, in1 = _degree_sequences(edges1, n1)
+    out2, in2 = _degree_sequences(edges2, n2)
+    degree_cost = math.ceil((_sorted_l1(out1, out2) + _sorted_l1(in1, in2)) / 2)
+    return abs(n1 - n2) + max(abs(len(edges1) - len(edges2)), degree_cost)
+
+
+def _mapping_cost(edges1, n1, edges2, n2, mapping):
+    # Cost of the edit path induced by a node mapping (mapping[node] is -1 for deleted nodes), in the unit cost
+    # model of nx.graph_edit_distance
+    cost = n1 + n2 - 2 * int((mapping >= 0).sum())
+    mapped = mapping[edges1]
+    kept = (mapped >= 0).all(axis=1)
+    cost += len(edges1) - int(kept.sum())
+    # Edges that survive the mapping are matched against edges2 as multisets of pair codes
+    codes1 = mapped[kept, 0].astype(np.int64) * max(n2, 1) + mapped[kept, 1]
+    codes2 = edges2[:, 0].astype(np.int64) * max(n2, 1) + edges2[:, 1]
+    codes, inverse = np.unique(np.concatenate([codes1, codes2]), return_inverse=True)
+    counts1 = np.bincount(inverse[:len(codes1)], minlength=len(codes))
+    counts2 = np.bincount(inverse[len(codes1):], minlength=len(codes))
+    return cost + int(np.abs(counts1 - counts2).sum())
+
+
+def ged_upper_bound(edges1, n1, edges2, n2, rooted):
+    # Bipartite GED approximation: solve a node assignment on local degree costs, then price the induced edit path
+    out1, in1 = _degree_sequences(edges1, n1)
+    out2, in2 = _degree_sequences(edges2, n2)
+    forbidden = 1e9
+    cost = np.zeros((n1 + n2, n1 + n2))
+    cost[:n1, :n2] = (np.abs(out1[:, None] - out2[None, :]) + np.abs(in1[:, None] - in2[None, :])) / 2
+    cost[:n1, n2:] = forbidden
+    cost[n1:, :n2] = forbidden
+    np.fill_diagonal(cost[:n1, n2:], 1 + (out1 + in1) / 2)
+    np.fill_diagonal(cost[n1:, :n2], 1 + (out2 + in2) / 2)
+    if rooted:
+        cost[0, :] = forbidden
+        cost[:, 0] = forbidden
+        cost[0, 0] = 0
+    rows, cols = linear_sum_assignment(cost)
+    mapping = np.full(n1, -1)
+    assigned = (rows < n1) & (cols < n2)
+    mapping[rows[assigned]] = cols[assigned]
+    return _mapping_cost(edges1, n1, edges2, n2, mapping)
+
+
+def _node_count(edges):
+    # Blocks are numbered in discovery order and every block but the entry is discovered through an edge, so the
+    # nodes are 0..n-1; the entry alone does not count, like in the edge list of an empty CFG
+    return int(edges.max()) + 1 if len(edges) else 0
+
+
+def _counted_digraph(edges):
+    # nx.graph_edit_distance does not keep parallel edges and self-loops consistent with the node mapping,
+    # so parallel edges are folded into an edge count and self-loops into a node attribute priced by the costs
+    graph = nx.DiGraph()
+    pairs, counts = _edge_counts(edges)
+    loops = Counter({u: count for (u, v), count in zip(pairs.tolist(), counts.tolist()) if u == v})
+    graph.add_nodes_from((node, {"loops": loops[node]}) for node in range(_node_count(edges)))
+    graph.add_edges_from((u, v, {"count": count}) for (u, v), count in zip(pairs.tolist(), counts.tolist()) if u != v)
+    return graph
+
+
+def cfg_similarity_from_edges(edges1, edges2, fingerprint1=None, fingerprint2=None, tolerance=GED_TOLERANCE,
+                              timeout=GED_TIMEOUT, same_source=False):
     div_const = 2 * (2 + len(edges1) + len(edges2))
-    g1, g2 = nx.MultiDiGraph(edges1), nx.MultiDiGraph(edges2)
     if len(edges1) + len(edges2) == 0: # Both graphs are empty (aka no edges, like a simple return statement)
-        return 1.0
-    if len(edges1) > 0 and len(edges2) > 0:
-        result = 1 - nx.graph_edit_distance(g1, g2, roots=(0, 0), timeout=60) / div_const
-    else:
-        result = 1 - nx.graph_edit_distance(g1, g2, timeout=60) / div_const
+        return CFGSimilarity(1.0, "trivial")
+    if same_source:
+        return CFGSimilarity(1.0, "isomorphic")
+
+    # The bounds are cheap, VF2 is only worth it when they leave the value open
+    rooted = len(edges1) > 0 and len(edges2) > 0
+    n1, n2 = _node_count(edges1), _node_count(edges2)
+    lower = ged_lower_bound(edges1, n1, edges2, n2)
+    upper = ged_upper_bound(edges1, n1, edges2, n2, rooted)
+    if upper - lower <= tolerance * div_const:
+        return CFGSimilarity(1 - upper / div_const, "bounds" if upper == lower else "approximate")
+    if fingerprint1 is not None and _same_cfg(edges1, fingerprint1, edges2, fingerprint2):
+        return CFGSimilarity(1.0, "isomorphic")
+
+    started = time.monotonic()
+    exact = nx.graph_edit_distance(_counted_digraph(edges1), _counted_digraph(edges2), roots=(0, 0) if rooted else None,
+                                   node_subst_cost=lambda a, b: abs(a["loops"] - b["loops"]),
+                                   node_del_cost=lambda a: 1 + a["loops"], node_ins_cost=lambda a: 1 + a["loops"],
+                                   edge_subst_cost=lambda a, b: abs(a["count"] - b["count"]),
+                                   edge_del_cost=lambda a: a["count"], edge_ins_cost=lambda a: a["count"],
+                                   timeout=timeout, upper_bound=upper)
+    tier = "exact" if time.monotonic() - started < timeout else "exact_timeout"
+    # None means the search found nothing better than the assignment-based path
+    distance = upper if exact is None else min(exact, upper)
+    result = 1 - distance / div_const
     if result < 0:
         raise Exception("What the hell???")
-    return result
+    return CFGSimilarity(result, tier)
+
+
+def _code_cfg_similarity(text1, text2, same_source=False):
+    edges1, fingerprint1 = cached_cfg(text1)
+    edges2, fingerprint2 = cached_cfg(text2)
+    return cfg_similarity_from_edges(edges1, edges2, fingerprint1, fingerprint2, same_source=same_source)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+# On-disk content-addressed store of LLM responses shared by all runs. Entries are keyed by everything that
+# determines a request (profile, system prompt, user prompt and sample index) and evicted least recently used
+# first once the cache grows beyond max_bytes.
+class ResponseCache:
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in self._entries())
+
+    @staticmethod
+    def key(profile: str, system_prompt: str, user_prompt: str, sample_index: int) -> str:
+        payload = json.dumps([profile, system_prompt, user_prompt, sample_index])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entries(self):
+        return self.path.glob("*/*.json")
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path.joinpath(key[:2], f"{key}.json")
+
+    def get(self, key: str):
+        entry_path = self._entry_path(key)
+        try:
+            with entry_path.open() as f:
+                response = json.load(f)["response"]
+            os.utime(entry_path)  # eviction goes by modification time
+        except (OSError, ValueError, KeyError):
+            return None
+        return response
+
+    def put(self, key: str, response: str):
+        entry_path = self._entry_path(key)
+        os.makedirs(entry_path.parent, exist_ok=True)
+        tmp_path = entry_path.with_name(f"{entry_path.name}.{threading.get_ident()}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump({"response": response}, f)
+        size = tmp_path.stat().st_size
+        os.replace(tmp_path, entry_path)
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop down to 90% of the limit so that eviction does not rescan the cache on every put
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            self._size -= size
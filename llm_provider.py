@@ -0,0 +1,359 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+
+from config import Config
+from extraction import CodeEndDetector
+from llm_cache import ResponseCache
+
+# Grazie profile of every model name accepted in the config, resolved only when the Grazie backend is used
+LLM_USED = {"claude-3.7": "ANTHROPIC_CLAUDE_37_SONNET",
+            "claude-3.5-sonnet": "ANTHROPIC_CLAUDE_35_SONNET",
+            "gpt-4": "OPENAI_GPT_4",
+            "gpt-4o-mini": "OPENAI_GPT_4_O_MINI",
+            "claude-3h": "ANTHROPIC_CLAUDE_3_HAIKU",
+            }
+
+# Marks the end of a stream pumped from a blocking client
+_DONE = object()
+# Sample index of the token usage a backend reports alongside the chunks
+USAGE = -1
+# Sample index of the marker a backend yields, with the finished sample's index, once the server ends a sample
+FINISHED = -2
+# Rough characters per token of code and English text, for requests whose tokens the server did not report
+CHARS_PER_TOKEN = 4
+# Statuses of a server rejecting a request for several samples
+REJECTED_STATUSES = {400, 422}
+
+
+# Raised by a backend whose server does not accept several samples per request
+class SamplesNotSupported(Exception):
+    pass
+
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+async def _pump(iterator_factory, executor):
+    # Streams a blocking iterator (e.g. requests-based) into the event loop through a worker thread
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    stop = threading.Event()
+
+    def run():
+        try:
+            iterator = iterator_factory()
+            try:
+                for item in iterator:
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(chunks.put_nowait, item)
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()  # drops the HTTP response of a cancelled stream
+            loop.call_soon_threadsafe(chunks.put_nowait, _DONE)
+        except BaseException as e:
+            if not stop.is_set():
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+
+    loop.run_in_executor(executor, run)
+    try:
+        while True:
+            item = await chunks.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class GrazieBackend:
+    def __init__(self, token, config: Config):
+        from grazie.api.client.chat.prompt import ChatPrompt
+        from grazie.api.client.endpoints import GrazieApiGatewayUrls
+        from grazie.api.client.gateway import AuthType, GrazieAgent, GrazieApiGatewayClient
+        from grazie.api.client.profiles import Profile
+
+        url = GrazieApiGatewayUrls.PRODUCTION if config.is_prod else GrazieApiGatewayUrls.STAGING
+        self.profile = getattr(Profile, LLM_USED[config.model.llm])
+        self.name = self.profile.name
+        self.chat_prompt = ChatPrompt
+        self.client = GrazieApiGatewayClient(
+            url=url,
+            grazie_jwt_token=token,
+            auth_type=AuthType.USER,
+            grazie_agent=GrazieAgent(name="grazie-api-gateway-client-heval-test", version="dev")
+        )
+        self.streaming = config.generation.stream
+        self.supports_samples = False
+        # The client is blocking, so the number of threads bounds the requests in flight
+        self.executor = ThreadPoolExecutor(max_workers=config.generation.max_connections,
+                                           thread_name_prefix="grazie")
+
+    # Yields (sample index, text) chunks and (USAGE, {"spent": credits}); the gateway returns a single sample per
+    # request
+    async def stream(self, system_prompt, user_prompt, n=1):
+        if n != 1:
+            raise SamplesNotSupported("The Grazie gateway returns one sample per request")
+        chat = self.chat_prompt().add_system(system_prompt).add_user(user_prompt)
+        if not self.streaming:
+            response = await asyncio.get_running_loop().run_in_executor(
+                self.executor, lambda: self.client.chat(chat=chat, profile=self.profile))
+            if response.spent is not None:
+                yield USAGE, {"spent": float(response.spent.amount)}
+            yield 0, response.content
+            return
+        chunks = _pump(lambda: self.client.chat_stream(chat=chat, profile=self.profile), self.executor)
+        try:
+            async for chunk in chunks:
+                if chunk.chunk:
+                    yield 0, chunk.chunk
+                # The gateway reports the quota credits a request spent instead of its tokens, with the last chunk
+                if chunk.spent is not None:
+                    yield USAGE, {"spent": float(chunk.spent.amount)}
+        finally:
+            await chunks.aclose()
+
+    async def aclose(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Any OpenAI-compatible chat completions endpoint (vLLM, a local stub server, ...), over pooled HTTP connections
+class OpenAIBackend:
+    def __init__(self, token, config: Config):
+        generation = config.generation
+        if generation.base_url is None:
+            raise ValueError("The openai backend needs generation.base_url")
+        self.name = config.model.llm
+        self.streaming = generation.stream
+        # Until the server rejects the n parameter
+        self.supports_samples = True
+        headers = {} if token is None else {"Authorization": f"Bearer {token}"}
+        self.client = httpx.AsyncClient(
+            base_url=generation.base_url, headers=headers, timeout=generation.request_timeout,
+            limits=httpx.Limits(max_connections=generation.max_connections,
+                                max_keepalive_connections=generation.max_connections))
+
+    def _request(self, system_prompt, user_prompt, n):
+        request = {"model": self.name, "stream": self.streaming,
+                   "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]}
+        if n != 1:
+            request["n"] = n
+        if self.streaming:
+            request["stream_options"] = {"include_usage": True}
+        return request
+
+    def _check(self, response, n):
+        if n != 1 and response.status_code in REJECTED_STATUSES:
+            self.supports_samples = False
+            raise SamplesNotSupported(f"{response.status_code} Error: {response.text}")
+        response.raise_for_status()
+
+    # Yields (sample index, text) chunks of all n samples, interleaved as the server sends them, (FINISHED, index)
+    # when a sample ends and (USAGE, usage) once the server reports the tokens of the request
+    async def stream(self, system_prompt, user_prompt, n=1):
+        request = self._request(system_prompt, user_prompt, n)
+        try:
+            if not self.streaming:
+                response = await self.client.post("/chat/completions", json=request)
+                self._check(response, n)
+                body = response.json()
+                # Before the choices, so a caller that stops reading once it has the code still gets it
+                if body.get("usage"):
+                    yield USAGE, body["usage"]
+                for choice in body["choices"]:
+                    yield choice.get("index", 0), choice["message"]["content"] or ""
+                return
+            async with self.client.stream("POST", "/chat/completions", json=request) as response:
+                if response.is_error:
+                    await response.aread()
+                    self._check(response, n)
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        return
+                    event = json.loads(data)
+                    for choice in event.get("choices") or []:
+                        content = choice.get("delta", {}).get("content")
+                        if content:
+                            yield choice.get("index", 0), content
+                        if choice.get("finish_reason"):
+                            yield FINISHED, choice.get("index", 0)
+                    if event.get("usage"):
+                        yield USAGE, event["usage"]
+        except httpx.TransportError as e:
+            # Connection errors and timeouts are retried like the OSErrors of the blocking client
+            raise ConnectionError(f"{type(e).__name__}: {e}") from e
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+BACKENDS = {
+    "grazie": GrazieBackend,
+    "openai": OpenAIBackend,
+}
+
+
+class AsyncLLMProvider:
+    def __init__(self, backend, config: Config):
+        self.backend = backend
+        self.prompt = config.model.prompt
+        generation = config.generation
+        self.early_stop = generation.early_stop
+        self.batch_samples = generation.batch_samples
+        self.cache = None if generation.cache_path is None else \
+            ResponseCache(Path(generation.cache_path), generation.cache_max_mb * 2 ** 20)
+
+    @property
+    def batches_samples(self):
+        return self.batch_samples and self.backend.supports_samples
+
+    async def _sample(self, task, n, stats, entry_point=None):
+        # (text, whether it was cut off) of the n samples of one request, None for samples the server did not return
+        stats["requests"] = stats.get("requests", 0) + 1
+        # A response that is not streamed arrives whole, there is nothing left to save by stopping early
+        early_stop = self.early_stop and self.backend.streaming
+        detectors = [CodeEndDetector(entry_point) for _ in range(n)]
+        ends = [None] * n
+        # Samples that lost chunks to early stop; only their text is cut at the end of the code
+        cut_off = [False] * n
+        received = set()
+        finished = set()
+        reported = False
+        chunks = self.backend.stream(self.prompt, task, n)
+        try:
+            async for index, chunk in chunks:
+                if index == USAGE:
+                    reported = True
+                    for field in ("prompt_tokens", "completion_tokens", "spent"):
+                        if chunk.get(field) is not None:
+                            stats[field] = stats.get(field, 0) + chunk[field]
+                    continue
+                if index == FINISHED:
+                    finished.add(chunk)
+                    continue
+                if index >= n:
+                    continue
+                if early_stop and ends[index] is not None:
+                    # The stream is only closed once something follows the code, so a response that ends with its
+                    # code block is received whole and can be cached
+                    if chunk.strip():
+                        cut_off[index] = True
+                        if all(end is not None and (cut or i in finished)
+                               for i, (end, cut) in enumerate(zip(ends, cut_off))):
+                            break
+                    continue
+                received.add(index)
+                end = detectors[index].feed(chunk)
+                if ends[index] is None:
+                    ends[index] = end
+            # Every sample of a stream read to its end is whole
+            finished.update(range(n))
+        finally:
+            await chunks.aclose()  # closes the connection of a stream cut off early
+        # Samples still running when the stream was closed lose whatever the server had left to send
+        cut_off = [cut or i not in finished for i, cut in enumerate(cut_off)]
+        if not reported:
+            # A stream cut off early ends before the server reports the tokens, so they are estimated from the text
+            stats["estimated_prompt_tokens"] = stats.get("estimated_prompt_tokens", 0) + \
+                estimate_tokens(self.prompt) + estimate_tokens(task)
+            stats["estimated_completion_tokens"] = stats.get("estimated_completion_tokens", 0) + \
+                sum(estimate_tokens(detectors[i].text) for i in received)
+        return [None if i not in received else
+                (detector.text[:end], True) if cut else (detector.text, False)
+                for i, (detector, end, cut) in enumerate(zip(detectors, ends, cut_off))]
+
+    async def make_calls(self, task, sample_indices, stats=None, entry_point=None):
+        # Fills stats with the number of requests, cache hits and the tokens (or Grazie credits) the backend reports,
+        # estimated for requests that ended without a report.
+        # With early stop a stream ends once the entry point is defined (any function without one) and prose follows.
+        stats = {} if stats is None else stats
+        # All samples of a task missing from the cache in one request when the backend supports it, the system
+        # prompt and task text are then sent and billed once instead of once per sample
+        contents = {}
+        keys = {}
+        if self.cache is not None:
+            for i in sample_indices:
+                keys[i] = ResponseCache.key(self.backend.name, self.prompt, task, i)
+                cached = self.cache.get(keys[i])
+                if cached is not None:
+                    contents[i] = cached
+        stats["cached"] = len(contents)
+        missing = [i for i in sample_indices if i not in contents]
+        # Samples whose stream was cut off are not cached, the cache only holds complete responses
+        cut_off = set()
+
+        def collect(i, sample):
+            text, cut = sample
+            contents[i] = text
+            if cut:
+                cut_off.add(i)
+
+        if len(missing) > 1 and self.batches_samples:
+            try:
+                for i, sample in zip(missing, await self._sample(task, len(missing), stats, entry_point)):
+                    if sample is not None:
+                        collect(i, sample)
+            except SamplesNotSupported as e:
+                print(f"Falling back to one request per sample: {e}")
+        # Samples a batch did not return (or all of them without batching) are requested one by one
+        rest = [i for i in missing if i not in contents]
+        errors = []
+        for i, samples in zip(rest, await asyncio.gather(*(self._sample(task, 1, stats, entry_point) for _ in rest),
+                                                         return_exceptions=True)):
+            if isinstance(samples, BaseException):
+                errors.append(samples)
+            else:
+                collect(i, samples[0] or ("", False))
+
+        # Cached before raising, so a retry only requests the samples that failed
+        if self.cache is not None:
+            for i in missing:
+                if i in contents and i not in cut_off and contents[i].strip():
+                    self.cache.put(keys[i], contents[i])
+        if errors:
+            raise errors[0]
+        return [contents[i] for i in sample_indices]
+
+    async def make_call(self, task, sample_index=0, entry_point=None):
+        return (await self.make_calls(task, [sample_index], entry_point=entry_point))[0]
+
+    async def aclose(self):
+        await self.backend.aclose()
+
+
+# Blocking facade over AsyncLLMProvider for the thread-based stages: every call runs on one event loop in a
+# background thread, so all threads share the backend's connection pool
+class LLMProvider:
+    def __init__(self, token, config: Config):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="llm-provider", daemon=True).start()
+        backend = BACKENDS[config.generation.backend](token, config)
+        self.provider = AsyncLLMProvider(backend, config)
+
+    @property
+    def batches_samples(self):
+        return self.provider.batches_samples
+
+    def make_call(self, task, sample_index=0, entry_point=None):
+        return asyncio.run_coroutine_threadsafe(self.provider.make_call(task, sample_index, entry_point),
+                                                self.loop).result()
+
+    def make_calls(self, task, sample_indices, stats=None, entry_point=None):
+        return asyncio.run_coroutine_threadsafe(self.provider.make_calls(task, sample_indices, stats, entry_point),
+                                                self.loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.provider.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,9 +1,13 @@
 import os
 from pathlib import Path
 
+from checkpoints import run_path, save_run_config, seed_from_previous_runs
 from metrics import perform_metrics
 from execution import run_all_tasks, evaluate_all, LLMProvider
+from pipeline import run_pipelined
+from profiling import profiled_run, stage
 from config import Config, get_config
+from utils import iter_tasks
 
 SYSTEM_PROMPT = """
     You are an exceptionally intelligent coding assistant that consistently delivers accurate and reliable responses to user instructions.
@@ -16,27 +20,35 @@ DATASETS = {
 }
 
 if __name__ == "__main__":
+    config = get_config()
     token = os.getenv("AI_TOKEN")
-    if token is None:
+    # A local OpenAI-compatible server usually needs no token
+    if token is None and config.generation.backend == "grazie":
         raise RuntimeError("AI_TOKEN is not provided")
-    config = get_config()
 
     provider = LLMProvider(token, config)
-    file_prefix = config.get_label()
-
-    work_path = Path("runs").joinpath(file_prefix)
+    work_path = run_path(config, Path("runs"))
     os.makedirs(work_path, exist_ok=True)
 
     solutions_path = work_path.joinpath("generated_solutions.jsonl")
     eval_results_path = work_path.joinpath("evaluation_results.jsonl")
     metrics_run_path = work_path.joinpath("metrics.jsonl")
 
-    if not solutions_path.exists():
-        run_all_tasks(provider=provider, config=config, output_path=solutions_path)
-
-    if not eval_results_path.exists():
-        evaluate_all(config=config, solutions_path=solutions_path, output_path=eval_results_path)
-
-    if not metrics_run_path.exists():
-        perform_metrics(config=config, solutions_path=solutions_path, eval_results_path=eval_results_path,
-                        output_path=metrics_run_path)
+    task_ids = [task["task_id"] for task in iter_tasks(config.data.dataset_path, config.evaluation.tasks)]
+    seed_from_previous_runs(config, work_path, task_ids)
+    save_run_config(config, work_path)
+
+    # Every stage only computes the (task_id, candidate_index) pairs missing from its checkpoint
+    with profiled_run(config, work_path):
+        if config.pipeline.enabled:
+            with stage("pipeline"):
+                run_pipelined(config=config, provider=provider, solutions_path=solutions_path,
+                              eval_results_path=eval_results_path, metrics_path=metrics_run_path)
+        else:
+            with stage("generation"):
+                run_all_tasks(provider=provider, config=config, output_path=solutions_path)
+            with stage("evaluation"):
+                evaluate_all(config=config, solutions_path=solutions_path, output_path=eval_results_path)
+            with stage("metrics"):
+                perform_metrics(config=config, solutions_path=solutions_path, eval_results_path=eval_results_path,
+                                output_path=metrics_run_path)
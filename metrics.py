@@ -1,42 +1,83 @@
-from difflib import SequenceMatcher
+import hashlib
+import importlib
 import json
+from contextlib import nullcontext
+from functools import cache
+from importlib.metadata import entry_points
+from itertools import islice
 from pathlib import Path
 
+from checkpoints import AtomicJsonlWriter, Checkpoint, checkpoint_path, record_key
 from config import Config
-from utils import load_tasks
-from graph_building import code_cfg_similarity, cfg_triviality
+from pairwise import PairCache, distinct_solutions, missing_pairs, pairwise_path, pairwise_result
+import profiling
+from results_store import open_result_store
+from text_similarity import similarity
+from utils import OrderedLookup, group_by_task, iter_jsonl, iter_tasks
+from worker_pool import OrderedResults, WorkerPool
 
+PLUGIN_GROUP = "heval_metrics"
 
-class SolutionMetric:
-    def __init__(self, name, metric_function, full_name=None):
+
+COSTS = ("cheap", "moderate", "heavy")
+
+
+class Metric:
+    # metric_function is a callable or a "module:function" path, imported on first use so that e.g. py2cfg and
+    # networkx are only loaded by runs that select a graph metric. A symmetric metric gives the same value for
+    # (a, b) and (b, a), so candidate-vs-candidate matrices compute one orientation of each pair.
+    def __init__(self, name, metric_function, full_name=None, version=1, tiered=False, cost="cheap", requires=(),
+                 symmetric=True):
+        if cost not in COSTS:
+            raise ValueError(f"Unknown cost {cost} of metric {name}, expected one of {COSTS}")
         self.name = name
         self.full_name = name if full_name is None else full_name
-        self.f = metric_function
+        self.metric_function = metric_function
+        self.version = version
+        self.tiered = tiered
+        self.cost = cost
+        self.requires = tuple(requires)
+        self.symmetric = symmetric
+
+    @property
+    def f(self):
+        if isinstance(self.metric_function, str):
+            module, function = self.metric_function.split(":")
+            self.metric_function = getattr(importlib.import_module(module), function)
+        return self.metric_function
 
+    def __call__(self, *args):
+        return self.f(*args)
+
+
+class SolutionMetric(Metric):
     def __call__(self, solution_candidate):
         return self.f(solution_candidate)
 
 
-class ComparativeMetric:
-    def __init__(self, name, metric_function, full_name=None):
-        self.name = name
-        self.full_name = name if full_name is None else full_name
-        self.f = metric_function
-
+class ComparativeMetric(Metric):
     def __call__(self, solution_candidate, reference_solution):
         return self.f(solution_candidate, reference_solution)
 
 
-class TaskMetric:
-    def __init__(self, name, metric_function, full_name=None):
-        self.name = name
-        self.full_name = name if full_name is None else full_name
-        self.f = metric_function
-
+class TaskMetric(Metric):
     def __call__(self, task_text):
         return self.f(task_text)
 
 
+# Combines the per-candidate values of the metrics it requires; computed in the main process when a task's result
+# is assembled, never sent to the workers or journaled, so changing the formula needs no recomputation
+class DerivedMetric(Metric):
+    def __init__(self, name, metric_function, requires, full_name=None, mean_name=None):
+        super().__init__(name, metric_function, full_name, requires=requires)
+        self.mean_name = f"Mean {name}" if mean_name is None else mean_name
+
+    def __call__(self, *values):
+        if None in values:
+            return None
+        return self.f(*values)
+
+
 def total_text_length(solution):
     return sum(map(lambda x: len(x.strip().rstrip()), solution.split("\n")))
 
@@ -50,86 +91,315 @@ def words_count(task_text):
 
 
 def gestalt_text_similarity(task_text, ref_text):
-    matcher = SequenceMatcher(None, task_text, ref_text)
-    return matcher.ratio()
+    # SequenceMatcher(None, task_text, ref_text).ratio(), with the reference indexed once per worker
+    return similarity("difflib", task_text, ref_text)
+
+
+def edit_text_similarity(task_text, ref_text):
+    return similarity("levenshtein", task_text, ref_text)
+
+
+def token_text_similarity(task_text, ref_text):
+    return similarity("tokens", task_text, ref_text)
+
+
+def interest(triviality, cfg_similarity, gestalt_similarity):
+    return cfg_similarity * (1 - triviality) * (1 - gestalt_similarity)
+
+
+ALL_METRICS = {}
+
+
+def register_metric(metric):
+    if metric.name in ALL_METRICS:
+        raise ValueError(f"Metric {metric.name} is already registered")
+    ALL_METRICS[metric.name] = metric
+    return metric
+
+
+for _metric in (
+        SolutionMetric("solution_length", total_text_length, "Solution length (characters)"),
+        SolutionMetric("solution_lines", lines_count, "Solution length (lines)"),
+        SolutionMetric("triviality", "graph_building:cfg_triviality", "Solution CFG triviality", version=2,
+                       cost="moderate"),
+        # SequenceMatcher's ratio depends on which text is the first one
+        ComparativeMetric("gestalt_similarity", gestalt_text_similarity, "Gestalt similarity between",
+                          cost="moderate", symmetric=False),
+        ComparativeMetric("edit_similarity", edit_text_similarity, "Edit distance similarity between",
+                          cost="moderate"),
+        ComparativeMetric("token_similarity", token_text_similarity, "Token edit distance similarity between",
+                          cost="moderate"),
+        ComparativeMetric("cfg_similarity", "graph_building:code_cfg_similarity", "CFG similarity between", version=3,
+                          tiered=True, cost="heavy"),
+        TaskMetric("task_length", total_text_length, "Task length (characters)"),
+        TaskMetric("task_lines", lines_count, "Task length (lines)"),
+        TaskMetric("task_words", words_count, "Task length (words)"),
+        DerivedMetric("Interest", interest, ("triviality", "cfg_similarity", "gestalt_similarity"),
+                      mean_name="Mean interest"),
+):
+    register_metric(_metric)
+
+@cache
+def load_plugins():
+    # Other packages add metrics through the "heval_metrics" entry point group, e.g.
+    #   [project.entry-points.heval_metrics]
+    #   halstead = "my_package.metrics:HALSTEAD"
+    # An entry point is a metric or a list of metrics.
+    # Loaded once per process; a global flag would make the first metric job look like it tampered with the module
+    for entry_point in entry_points(group=PLUGIN_GROUP):
+        loaded = entry_point.load()
+        for metric in loaded if isinstance(loaded, (list, tuple)) else [loaded]:
+            register_metric(metric)
+
+
+def metric_registry():
+    load_plugins()
+    return ALL_METRICS
+
 
+def cheap_first(metrics):
+    return sorted(metrics, key=lambda metric: COSTS.index(metric.cost))
 
-ALL_METRICS = {
-    "solution_length": SolutionMetric("solution_length", total_text_length, "Solution length (characters)"),
-    "solution_lines": SolutionMetric("solution_lines", lines_count, "Solution length (lines)"),
-    "triviality": SolutionMetric("triviality", cfg_triviality, "Solution CFG triviality"),
-    "gestalt_similarity": ComparativeMetric("gestalt_similarity", gestalt_text_similarity, "Gestalt similarity between"),
-    "cfg_similarity": ComparativeMetric("cfg_similarity", code_cfg_similarity, "CFG similarity between"),
-    "task_length": TaskMetric("task_length", total_text_length, "Task length (characters)"),
-    "task_lines": TaskMetric("task_lines", lines_count, "Task length (lines)"),
-    "task_words": TaskMetric("task_words", words_count, "Task length (words)"),
-}
+
+def select_metrics(config: Config):
+    # The configured metrics (all of them if none are) with everything they require, cheap metrics first.
+    # Derived metrics are added whenever all of their inputs are selected anyway.
+    registry = metric_registry()
+    requested = list(registry) if len(config.evaluation.metrics) == 0 else config.evaluation.metrics
+    selected = {}
+
+    def add(name, required_by=None):
+        if name in selected:
+            return
+        if name not in registry:
+            raise ValueError(f"Unknown metric {name}" + (f" required by {required_by}" if required_by else ""))
+        selected[name] = registry[name]
+        for dependency in registry[name].requires:
+            add(dependency, name)
+
+    for name in requested:
+        add(name)
+    for metric in registry.values():
+        if isinstance(metric, DerivedMetric) and all(name in selected for name in metric.requires):
+            add(metric.name)
+    return cheap_first(selected.values())
 
 
 def get_metrics_split(config: Config):
-    all_metrics_keys = ALL_METRICS.keys() if len(config.evaluation.metrics) == 0 else config.evaluation.metrics
-    all_metrics = [ALL_METRICS[x] for x in all_metrics_keys]
+    all_metrics = select_metrics(config)
     solution_metrics = list(filter(lambda metric: isinstance(metric, SolutionMetric), all_metrics))
     comparative_metrics = list(filter(lambda metric: isinstance(metric, ComparativeMetric), all_metrics))
     task_metrics = list(filter(lambda metric: isinstance(metric, TaskMetric), all_metrics))
-    return solution_metrics, comparative_metrics, task_metrics
+    derived_metrics = list(filter(lambda metric: isinstance(metric, DerivedMetric), all_metrics))
+    return solution_metrics, comparative_metrics, task_metrics, derived_metrics
+
+
+def compute_metric(name, args):
+    return metric_registry()[name](*args)
+
+
+def timed_metric(name, args):
+    return profiling.measure(compute_metric, name, args)
+
+
+def metric_input_hash(args):
+    return hashlib.sha1(json.dumps(args).encode()).hexdigest()
+
+
+def is_fresh(cell, metric, input_hash):
+    # A value is reused only if it was computed by the same metric version on the same inputs
+    provenance = cell.get("provenance", {}).get(metric.name)
+    return metric.name in cell and provenance == {"version": metric.version, "input": input_hash}
+
+
+def import_legacy_metrics(result, solutions, reference_solution, checkpoint):
+    # Runs from before metric checkpoints only have metrics.jsonl, with per-candidate lists in solution order
+    for i, record in enumerate(solutions):
+        cell = {"task_id": result["task_id"], "candidate_index": record["candidate_index"], "provenance": {}}
+        for name, metric in metric_registry().items():
+            values = result.get(name)
+            if isinstance(metric, (TaskMetric, DerivedMetric)) or not isinstance(values, list) or len(values) != len(solutions):
+                continue
+            cell[name] = values[i]
+            args = metric_args(metric, record, reference_solution)
+            cell["provenance"][name] = {"version": 1, "input": metric_input_hash(args)}
+        checkpoint.add(cell)
+
+
+def metric_args(metric, record, reference_solution):
+    if isinstance(metric, ComparativeMetric):
+        return record["solution"], reference_solution
+    return (record["solution"],)
+
+
+def candidate_cell(checkpoint, key):
+    cell = dict(checkpoint.get(key, {"task_id": key[0], "candidate_index": key[1]}))
+    cell["provenance"] = dict(cell.get("provenance", {}))
+    return cell
+
+
+def missing_metric_units(cell, record, reference_solution, candidate_metrics):
+    units = []
+    for metric in candidate_metrics:
+        args = metric_args(metric, record, reference_solution)
+        input_hash = metric_input_hash(args)
+        if not is_fresh(cell, metric, input_hash):
+            units.append((metric, args, input_hash))
+    return units
+
+
+def unwrap_measured(status, value):
+    if status == "ok" and isinstance(value, dict) and value.get("measured"):
+        return value["value"], {"worker_wall": value["wall"], "cpu": value["cpu"]}
+    return value, {}
+
+
+def store_metric_value(cell, metric, input_hash, status, value, duration=None):
+    # duration is None for duplicates the value is copied to, so the computation is only recorded once
+    value, timing = unwrap_measured(status, value)
+    if duration is not None:
+        profiling.record("metric", task_id=cell["task_id"], candidate_index=cell["candidate_index"],
+                         name=metric.name, status=status, wall=duration, tier=getattr(value, "tier", None), **timing)
+    if status == "ok":
+        cell[metric.name] = value
+        cell.pop(f"{metric.name}_error", None)
+        cell["provenance"][metric.name] = {"version": metric.version, "input": input_hash}
+        # Metrics backed by a tiered engine (e.g. CFG similarity) report how each value was obtained
+        if hasattr(value, "tier"):
+            cell[f"{metric.name}_tier"] = value.tier
+    else:
+        print(f"Metric {metric.name} failed for {cell['task_id']} candidate {cell['candidate_index']}: {value}")
+        # Without provenance the failed value is retried by the next run
+        cell[metric.name] = None
+        cell[f"{metric.name}_error"] = value
+
+
+def store_pair_value(pairs, key, metric, task_id, status, value, duration):
+    value, timing = unwrap_measured(status, value)
+    profiling.record("metric", task_id=task_id, name=f"pairwise_{metric.name}", status=status, wall=duration,
+                     tier=getattr(value, "tier", None), **timing)
+    if status == "ok":
+        pairs.add(key, value)
+    else:
+        # Left out of the cache, so the pair is retried by the next run
+        print(f"Pairwise {metric.name} failed for {task_id}: {value}")
+
+
+def share_units(units):
+    # Candidates with byte-identical solutions have the same metric inputs, so each input is computed once and
+    # its value copied to every candidate sharing it
+    shared = {}
+    for key, cell, metric, args, input_hash in units:
+        shared.setdefault((metric.name, input_hash), (metric, args, input_hash, []))[3].append((key, cell))
+    return list(shared.values())
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def task_result(task, evaluation, cells, task_metrics, candidate_metrics, derived_metrics):
+    result = {"task_id": task["task_id"], "passes": evaluation["passes"], "pass@k": evaluation["pass@k"]}
+    for metric in task_metrics:
+        result[metric.name] = metric(task["prompt"])
+
+    for metric in candidate_metrics:
+        result[metric.name] = [cell[metric.name] for cell in cells]
+        result[f"Mean {metric.name}"] = mean(result[metric.name])
+        if any(f"{metric.name}_tier" in cell for cell in cells):
+            result[f"{metric.name}_tier"] = [cell.get(f"{metric.name}_tier") for cell in cells]
+
+    for metric in derived_metrics:
+        result[metric.name] = [metric(*values) for values in zip(*(result[name] for name in metric.requires))]
+        result[metric.mean_name] = mean(result[metric.name])
+    return result
 
 
 def perform_metrics(config: Config, solutions_path: Path, eval_results_path: Path, output_path: Path):
-    tasks = {task["task_id"]: task for task in load_tasks(config.data.dataset_path)}
-    solution_metrics, comparative_metrics, task_metrics = get_metrics_split(config)
-    grouped_solutions = {}
-    evaluation_results = {}
-    pass_at_k = {}
-
-    with solutions_path.open() as f, eval_results_path.open() as f_e:
-        for line in f:
-            record = json.loads(line)
-            grouped_solutions.setdefault(record["task_id"], []).append(record["solution"])
-        for line in f_e:
-            record = json.loads(line)
-            evaluation_results[record["task_id"]] = record["passes"]
-            pass_at_k[record["task_id"]] = record["pass@k"]
-
-    task_ids = list(grouped_solutions.keys())
-    task_ids = task_ids[:config.evaluation.tasks]
-
-    results = []
-    for task_id in task_ids:
-        print(f"Metrics calculation starting for {task_id}")
-        task = tasks[task_id]
-        prompt = task["prompt"]
-        reference_solution = task["canonical_solution"]
-
-        result = {"task_id": task_id, "passes": evaluation_results[task_id], "pass@k": pass_at_k[task_id]}
-        for metric in task_metrics:
-            result[metric.name] = metric(prompt)
-
-        solutions = grouped_solutions[task_id]
-        n = len(solutions)
-        for metric in comparative_metrics:
-            result[metric.name] = []
-            for idx, solution in enumerate(solutions):
-                result[metric.name].append(metric(solution, reference_solution))
-            result[f"Mean {metric.name}"] = sum(result[metric.name]) / n
-
-        for metric in solution_metrics:
-            result[metric.name] = []
-            for idx, solution in enumerate(solutions):
-                result[metric.name].append(metric(solution))
-            result[f"Mean {metric.name}"] = sum(result[metric.name]) / n
-
-        interest = []
-        triviality, cfg_similarity, text_similarity = result["triviality"], result[
-            "cfg_similarity"], result["gestalt_similarity"]
-        for i in range(len(triviality)):
-            interest.append(cfg_similarity[i] * (1 - triviality[i]) * (1 - text_similarity[i]))
-        result["Interest"] = interest
-        result["Mean interest"] = sum(interest) / n
-
-        results.append(result)
-
-    with open(output_path, 'w') as f:
-        for result in results:
-            f.write(json.dumps(result) + "\n")
-    return results
+    solution_metrics, comparative_metrics, task_metrics, derived_metrics = get_metrics_split(config)
+    candidate_metrics = cheap_first(comparative_metrics + solution_metrics)
+    pairwise_metrics = [metric for metric in comparative_metrics if metric.name in config.evaluation.pairwise_metrics]
+    tasks = OrderedLookup(iter_tasks(config.data.dataset_path))
+    evaluation_results = OrderedLookup(iter_jsonl(eval_results_path))
+    groups = islice(group_by_task(iter_jsonl(solutions_path)), config.evaluation.tasks)
+
+    metrics_checkpoint_path = checkpoint_path(output_path)
+    legacy_results = None
+    if output_path.exists() and not metrics_checkpoint_path.exists():
+        legacy_results = OrderedLookup(iter_jsonl(output_path))
+
+    # Candidate cells still waiting for some of their metrics
+    pending_cells = {}
+    counts = {"total": 0, "fresh": 0}
+
+    store = open_result_store(output_path, candidate_metrics, derived_metrics, config.evaluation.parquet)
+
+    def write_result(checkpoint, pairs, writer, state):
+        cells = checkpoint.ordered(state["keys"])
+        result = task_result(state["task"], state["evaluation"], cells, task_metrics, candidate_metrics,
+                             derived_metrics)
+        result.update(pairwise_result(pairs, pairwise_metrics, state["hashes"]))
+        writer.write(result)
+        if store is not None:
+            store.add(result, cells, state["evaluation"])
+
+    def jobs(checkpoint, pairs, results):
+        nonlocal legacy_results
+        for task_id, solutions in groups:
+            print(f"Metrics calculation starting for {task_id}")
+            task = tasks.get(task_id)
+            reference_solution = task["canonical_solution"]
+            state = {"task": task, "evaluation": evaluation_results.get(task_id),
+                     "keys": [record_key(record) for record in solutions]}
+            if legacy_results is not None:
+                try:
+                    import_legacy_metrics(legacy_results.get(task_id), solutions, reference_solution, checkpoint)
+                except KeyError:  # the old run did not cover the remaining tasks
+                    legacy_results = None
+
+            units = []
+            for record in solutions:
+                key = record_key(record)
+                cell = candidate_cell(checkpoint, key)
+                missing = [(key, cell, *unit)
+                           for unit in missing_metric_units(cell, record, reference_solution, candidate_metrics)]
+                counts["total"] += len(candidate_metrics)
+                counts["fresh"] += len(candidate_metrics) - len(missing)
+                if missing:
+                    pending_cells[key] = len(missing)
+                    units.extend(missing)
+            state["hashes"], representatives = distinct_solutions(solutions)
+            pair_units = missing_pairs(pairs, pairwise_metrics, representatives)
+            # The task is done once each of its unfinished cells and missing pairs is
+            results.start(state, len({key for key, *_ in units}) + len(pair_units))
+            for metric, args, input_hash, targets in share_units(units):
+                results.submit((metric, input_hash, targets, state))
+                yield metric.name, args
+            for pair_key, metric, args in pair_units:
+                # A pair has no candidate cells to fill
+                results.submit((metric, pair_key, None, state))
+                yield metric.name, args
+
+    with Checkpoint(metrics_checkpoint_path) as checkpoint, PairCache(pairwise_path(output_path)) as pairs, \
+            AtomicJsonlWriter(output_path) as writer, store or nullcontext(), \
+            WorkerPool(processes=config.evaluation.workers, timeout=config.evaluation.metric_timeout) as pool:
+        results = OrderedResults(lambda state: write_result(checkpoint, pairs, writer, state))
+        for job_id, status, value in pool.imap_unordered(timed_metric, jobs(checkpoint, pairs, results)):
+            metric, unit_key, targets, state = results.take(job_id)
+            if targets is None:
+                store_pair_value(pairs, unit_key, metric, state["task"]["task_id"], status, value, pool.last_duration)
+                results.done(state)
+                continue
+            finished = 0
+            for i, (key, cell) in enumerate(targets):
+                store_metric_value(cell, metric, unit_key, status, value, pool.last_duration if i == 0 else None)
+                pending_cells[key] -= 1
+                if pending_cells[key] == 0:
+                    # A candidate's cell is journaled once all of its metrics are done
+                    del pending_cells[key]
+                    checkpoint.add(cell)
+                    finished += 1
+            results.done(state, finished)
+
+    print(f"{counts['fresh']} of {counts['total']} candidate metric values were already up to date")
@@ -0,0 +1,87 @@
+import json
+from pathlib import Path
+
+from checkpoints import truncate_torn_tail
+from utils import iter_jsonl, solution_hash
+
+PAIRWISE_FILE = "pairwise_similarity.jsonl"
+
+
+def pairwise_path(metrics_path: Path) -> Path:
+    return metrics_path.with_name(PAIRWISE_FILE)
+
+
+# Append-only journal of candidate-vs-candidate similarities, keyed by metric, metric version and the normalized
+# source hashes of the two solutions, so a pair is computed once across tasks and resumed runs
+class PairCache:
+    def __init__(self, path: Path):
+        self.path = path
+        self.values = {}
+        if path.exists():
+            truncate_torn_tail(path)
+            for record in iter_jsonl(path):
+                self.values[record["metric"], record["version"], record["a"], record["b"]] = record["value"]
+        self.file = path.open("a")
+
+    @staticmethod
+    def key(metric, a, b):
+        # Only one orientation of a pair of a symmetric metric is computed; a is the candidate, b the one compared to
+        return (metric.name, metric.version) + ((a, b) if a <= b or not metric.symmetric else (b, a))
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def add(self, key, value):
+        name, version, a, b = key
+        self.values[key] = value
+        self.file.write(json.dumps({"metric": name, "version": version, "a": a, "b": b, "value": value}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def distinct_solutions(solutions):
+    # Normalized source hash of every candidate and one representative solution text per hash
+    hashes = [solution_hash(record["solution"]) for record in solutions]
+    representatives = {}
+    for digest, record in zip(hashes, solutions):
+        representatives.setdefault(digest, record["solution"])
+    return hashes, representatives
+
+
+def missing_pairs(cache: PairCache, metrics, representatives):
+    # (cache key, metric, args) of every pair of distinct solutions of a task that is not computed yet
+    digests = sorted(representatives)
+    units = []
+    for metric in metrics:
+        for i, first in enumerate(digests):
+            for second in digests[i + 1:]:
+                for a, b in ((first, second), (second, first)) if not metric.symmetric else ((first, second),):
+                    key = PairCache.key(metric, a, b)
+                    if key not in cache:
+                        units.append((key, metric, (representatives[a], representatives[b])))
+    return units
+
+
+def pairwise_result(cache: PairCache, metrics, hashes):
+    # n x n similarity matrices over a task's candidates (identical solutions count as 1), row i holding candidate i
+    # compared to every other, and the diversity of the candidates, one minus their mean similarity over all ordered
+    # pairs (both orientations of a metric that is not symmetric)
+    result = {"distinct_solutions": len(set(hashes))}
+    for metric in metrics:
+        matrix = [[1.0 if a == b else cache.get(PairCache.key(metric, a, b)) for b in hashes] for a in hashes]
+        values = [matrix[i][j] for i in range(len(hashes)) for j in range(len(hashes))
+                  if i != j and matrix[i][j] is not None]
+        result[f"pairwise_{metric.name}"] = matrix
+        result[f"{metric.name}_diversity"] = 1 - sum(values) / len(values) if values else None
+    return result
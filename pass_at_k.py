@@ -0,0 +1,72 @@
+from math import lgamma
+
+import numpy as np
+
+
+def _fail_curves(n, correct):
+    # C(n - c, k) / C(n, k) for k = 1..n as the product prod_{j < k} (n - c - j) / (n - j), which stays in
+    # floating point where math.comb would build big integers
+    j = np.arange(n)
+    c = np.asarray(correct)[..., None]
+    return np.cumprod(np.clip((n - c - j) / (n - j), 0, None), axis=-1)
+
+
+def pass_at_k(n, c, k):
+    if k < 1:
+        raise ValueError(f"k must be at least 1, got {k}")
+    k = min(n, k)
+    if n == 0 or c == 0:
+        return 0.0
+    return float(1 - _fail_curves(n, c)[k - 1])
+
+
+def pass_at_k_curve(passes):
+    # Unbiased pass@k of one task for every k = 1..n and its standard error. The error is the exact bootstrap one
+    # over the task's candidates: resampling n candidates with replacement gives Binomial(n, c / n) correct ones.
+    passes = np.asarray(passes, dtype=bool)
+    n = len(passes)
+    c = int(passes.sum())
+    curve = 1 - _fail_curves(n, c)
+    if c in (0, n):
+        return curve, np.zeros(n)
+    counts = np.arange(n + 1)
+    log_binomial = np.array([lgamma(n + 1) - lgamma(i + 1) - lgamma(n - i + 1) for i in counts])
+    pmf = np.exp(log_binomial + counts * np.log(c / n) + (n - counts) * np.log1p(-c / n))
+    table = 1 - _fail_curves(n, counts)
+    mean = pmf @ table
+    return curve, np.sqrt(np.clip(pmf @ (table - mean) ** 2, 0, None))
+
+
+def at_k(curve, k):
+    # Tasks with fewer than k candidates count with all of them, as in pass_at_k
+    if k < 1:
+        raise ValueError(f"k must be at least 1, got {k}")
+    if len(curve) == 0:
+        return 0.0
+    return float(curve[min(k, len(curve)) - 1])
+
+
+def _padded(curves, max_k):
+    padded = np.zeros((len(curves), max_k))
+    for i, curve in enumerate(curves):
+        curve = np.asarray(curve, dtype=float)[:max_k]
+        if len(curve):
+            padded[i, :len(curve)] = curve
+            padded[i, len(curve):] = curve[-1]
+    return padded
+
+
+def aggregate_curve(curves, ses, max_k=None):
+    # Mean pass@k over tasks for k = 1..max_k with two standard errors: "se" treats the tasks as a sample
+    # (bootstrap over tasks), "se_sampling" only covers the noise of sampling candidates for fixed tasks
+    if not curves:
+        return {"pass@k": [], "se": [], "se_sampling": []}
+    max_k = max_k or max(len(curve) for curve in curves)
+    values = _padded(curves, max_k)
+    sampling = _padded(ses, max_k)
+    tasks = len(curves)
+    return {
+        "pass@k": values.mean(axis=0).tolist(),
+        "se": (values.std(axis=0) / np.sqrt(tasks)).tolist(),
+        "se_sampling": (np.sqrt((sampling ** 2).sum(axis=0)) / tasks).tolist(),
+    }
@@ -0,0 +1,207 @@
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import count
+from pathlib import Path
+
+from checkpoints import Checkpoint, checkpoint_path, record_key
+from config import Config
+from execution import CandidateRuns, LLMProvider, evaluate_all, evaluation_job, evaluation_pool, generation_batches, \
+    generation_threads, run_all_tasks, solution_generator
+from metrics import candidate_cell, cheap_first, get_metrics_split, missing_metric_units, perform_metrics, \
+    store_metric_value, timed_metric
+from utils import iter_tasks
+from worker_pool import PENDING, WorkerPool, run_job
+
+# Marks the end of a stage's stream of candidates
+_DONE = object()
+PUT_POLL_INTERVAL = 0.5
+
+
+class _Stage(threading.Thread):
+    # Runs one stage on its own thread. A failed stage stops the whole pipeline instead of leaving its
+    # neighbours blocked on a queue that is never drained or never closed.
+    def __init__(self, name, target, failed, errors):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.failed = failed
+        self.errors = errors
+
+    def run(self):
+        try:
+            self.target()
+        except BaseException as e:
+            self.errors.append(e)
+            self.failed.set()
+
+
+def _put(q: queue.Queue, item, failed: threading.Event):
+    if q is None:  # the next stage is not part of this pipeline
+        return
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=PUT_POLL_INTERVAL)
+            return
+        except queue.Full:
+            continue
+    raise RuntimeError("Pipeline stopped by a failed stage")
+
+
+def _drain(q: queue.Queue, failed: threading.Event):
+    # Job source for a WorkerPool: hands over whatever is queued and lets the pool keep working in between
+    while True:
+        if failed.is_set():
+            raise RuntimeError("Pipeline stopped by a failed stage")
+        try:
+            item = q.get_nowait()
+        except queue.Empty:
+            yield PENDING
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+
+def _generate(config: Config, provider: LLMProvider, tasks, output_path: Path, out_queue, failed):
+    generate = solution_generator(config, provider)
+    max_workers = generation_threads(config)
+    with Checkpoint(checkpoint_path(output_path)) as checkpoint, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+
+        def collect(block):
+            done, _ = wait(in_flight, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for future in done:
+                task_id = in_flight.pop(future)
+                for cand, outcome in future.result():
+                    if isinstance(outcome, Exception):
+                        print(f"Error in task {task_id}, candidate {cand}: {outcome}")
+                        continue
+                    checkpoint.add(outcome)
+                    print(f"Task {task_id} candidate {cand} solution generated.")
+                    _put(out_queue, outcome, failed)
+
+        try:
+            for task in tasks.values():
+                missing = []
+                for cand in range(config.evaluation.candidates):
+                    record = checkpoint.get((task["task_id"], cand))
+                    if record is not None:
+                        _put(out_queue, record, failed)
+                    else:
+                        missing.append(cand)
+                for batch in generation_batches(provider, missing):
+                    while len(in_flight) >= 2 * max_workers:
+                        collect(block=True)
+                    in_flight[executor.submit(generate, task, batch)] = task["task_id"]
+                    collect(block=False)
+            while in_flight:
+                collect(block=True)
+        finally:
+            for future in in_flight:
+                future.cancel()
+    _put(out_queue, _DONE, failed)
+
+
+def _evaluate(config: Config, tasks, output_path: Path, in_queue, out_queue, failed):
+    in_flight = {}
+    job_ids = count()
+
+    def jobs(runs):
+        for record in _drain(in_queue, failed):
+            if record is PENDING:
+                yield PENDING
+                continue
+            run = runs.admit(record)
+            if run is None:
+                _put(out_queue, record, failed)
+            elif run[2]:
+                in_flight[next(job_ids)] = run[:2]
+                yield evaluation_job(config, tasks[record["task_id"]], record["solution"])
+
+    with Checkpoint(checkpoint_path(output_path)) as checkpoint, evaluation_pool(config) as pool:
+        runs = CandidateRuns(config, checkpoint)
+        for job_id, status, result in pool.imap_unordered(run_job, jobs(runs)):
+            rkey, digest = in_flight.pop(job_id)
+            for record in runs.complete(rkey, digest, status, result, pool.last_duration):
+                _put(out_queue, record, failed)
+    _put(out_queue, _DONE, failed)
+
+
+def _compute_metrics(config: Config, tasks, output_path: Path, in_queue, failed):
+    solution_metrics, comparative_metrics, _, _ = get_metrics_split(config)
+    candidate_metrics = cheap_first(comparative_metrics + solution_metrics)
+    in_flight = {}
+    # (metric, input hash) -> the job computing it, which duplicates arriving in the meantime join
+    running = {}
+    pending_cells = {}
+    job_ids = count()
+
+    def jobs(checkpoint):
+        for record in _drain(in_queue, failed):
+            if record is PENDING:
+                yield PENDING
+                continue
+            key = record_key(record)
+            cell = candidate_cell(checkpoint, key)
+            units = missing_metric_units(cell, record, tasks[key[0]]["canonical_solution"], candidate_metrics)
+            if units:
+                pending_cells[key] = len(units)
+            for metric, args, input_hash in units:
+                if (metric.name, input_hash) in running:
+                    in_flight[running[metric.name, input_hash]][2].append((key, cell))
+                    continue
+                running[metric.name, input_hash] = job_id = next(job_ids)
+                in_flight[job_id] = metric, input_hash, [(key, cell)]
+                yield metric.name, args
+
+    with Checkpoint(checkpoint_path(output_path)) as checkpoint, \
+            WorkerPool(processes=config.evaluation.workers, timeout=config.evaluation.metric_timeout) as pool:
+        for job_id, status, value in pool.imap_unordered(timed_metric, jobs(checkpoint)):
+            metric, input_hash, targets = in_flight.pop(job_id)
+            del running[metric.name, input_hash]
+            for i, (key, cell) in enumerate(targets):
+                store_metric_value(cell, metric, input_hash, status, value, pool.last_duration if i == 0 else None)
+                pending_cells[key] -= 1
+                if pending_cells[key] == 0:
+                    del pending_cells[key]
+                    checkpoint.add(cell)
+                    print(f"Task {key[0]} candidate {key[1]} metrics computed.")
+
+
+def run_pipelined(config: Config, provider: LLMProvider, solutions_path: Path, eval_results_path: Path,
+                  metrics_path: Path):
+    # Every candidate flows into evaluation and then into metrics as soon as it is generated. The stages journal
+    # into their usual checkpoints, so partial results are visible during the run and an interrupted pipeline
+    # resumes like the sequential stages. The per-task output files are assembled from the checkpoints at the end.
+    tasks = {task["task_id"]: task for task in iter_tasks(config.data.dataset_path, config.evaluation.tasks)}
+    queue_size = config.pipeline.queue_size
+    # Metrics of a run from before metric checkpoints are imported by perform_metrics, so leave them to it
+    legacy_metrics = metrics_path.exists() and not checkpoint_path(metrics_path).exists()
+    to_evaluation = queue.Queue(maxsize=queue_size)
+    to_metrics = None if legacy_metrics else queue.Queue(maxsize=queue_size)
+    failed = threading.Event()
+    errors = []
+
+    stages = [
+        _Stage("generation", lambda: _generate(config, provider, tasks, solutions_path, to_evaluation, failed),
+               failed, errors),
+        _Stage("evaluation", lambda: _evaluate(config, tasks, eval_results_path, to_evaluation, to_metrics, failed),
+               failed, errors),
+    ]
+    if to_metrics is not None:
+        stages.append(_Stage("metrics", lambda: _compute_metrics(config, tasks, metrics_path, to_metrics, failed),
+                             failed, errors))
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    if errors:
+        # The first stage to fail stops the others, their errors are only a consequence of it
+        raise errors[0]
+
+    # Nothing is left to compute here apart from candidates whose generation failed, which get one more attempt
+    run_all_tasks(config=config, provider=provider, output_path=solutions_path)
+    evaluate_all(config=config, solutions_path=solutions_path, output_path=eval_results_path)
+    perform_metrics(config=config, solutions_path=solutions_path, eval_results_path=eval_results_path,
+                    output_path=metrics_path)
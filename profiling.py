@@ -0,0 +1,209 @@
+import argparse
+import cProfile
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from utils import iter_jsonl
+
+TIMINGS_FILE = "timings.jsonl"
+SUMMARY_FILE = "timings_summary.json"
+
+# Timings of the current run, None when nothing is recorded (e.g. stages called from a notebook)
+_recorder = None
+
+
+# Appends one JSON line per measured unit of work (a generation request, a candidate run, a metric value) to the
+# run's timings file. Resumed runs append to the same file under a new run id.
+class TimingRecorder:
+    def __init__(self, path: Path):
+        self.path = path
+        self.run = time.strftime("%Y%m%d-%H%M%S")
+        self._lock = threading.Lock()
+        self.file = path.open("a")
+
+    def record(self, stage, **fields):
+        line = json.dumps({"run": self.run, "stage": stage, **fields})
+        with self._lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def record(stage, **fields):
+    if _recorder is not None:
+        _recorder.record(stage, **fields)
+
+
+def measure(fn, *args):
+    # Runs inside a worker: the result with the wall and CPU time the worker spent on it
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    value = fn(*args)
+    return {"measured": True, "value": value, "wall": time.perf_counter() - wall_start,
+            "cpu": time.process_time() - cpu_start}
+
+
+@contextmanager
+def stage(name):
+    # Whole-stage totals of the main process, next to the per-unit records of the stage
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        record("stage", name=name, wall=time.perf_counter() - wall_start, cpu=time.process_time() - cpu_start)
+
+
+def _start_py_spy(work_path: Path):
+    executable = shutil.which("py-spy")
+    if executable is None:
+        print("py-spy is not installed, skipping the sampling profile")
+        return None
+    # Samples the workers as well; needs ptrace permissions (e.g. sudo or kernel.yama.ptrace_scope = 0)
+    return subprocess.Popen([executable, "record", "--pid", str(os.getpid()), "--subprocesses", "--format",
+                             "speedscope", "--output", str(work_path.joinpath("py-spy.json"))])
+
+
+@contextmanager
+def profiled_run(config, work_path: Path):
+    global _recorder
+    profiling = config.profiling
+    if not profiling.enabled:
+        yield
+        return
+    _recorder = TimingRecorder(work_path.joinpath(TIMINGS_FILE))
+    profiler = cProfile.Profile() if profiling.cprofile else None
+    sampler = _start_py_spy(work_path) if profiling.py_spy else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            # Main process only: generation threads, scheduling and result handling, not the workers
+            profiler.disable()
+            profiler.dump_stats(work_path.joinpath("profile.prof"))
+        if sampler is not None:
+            sampler.send_signal(signal.SIGINT)
+            sampler.wait()
+        run = _recorder.run
+        _recorder.close()
+        _recorder = None
+        summary = summarize(work_path.joinpath(TIMINGS_FILE), run)
+        with work_path.joinpath(SUMMARY_FILE).open("w") as f:
+            json.dump(summary, f, indent=2)
+        print_summary(summary)
+
+
+def _distribution(values):
+    values = np.asarray([value for value in values if value is not None], dtype=float)
+    if len(values) == 0:
+        return {"count": 0, "total": 0.0}
+    return {"count": len(values), "total": float(values.sum()), "mean": float(values.mean()),
+            "p50": float(np.quantile(values, 0.5)), "p95": float(np.quantile(values, 0.95)),
+            "max": float(values.max())}
+
+
+def _sum(records, field):
+    return sum(record.get(field) or 0 for record in records)
+
+
+def _count(values):
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+def summarize(path: Path, run=None):
+    records = list(iter_jsonl(path))
+    if run is None and records:
+        run = records[-1]["run"]
+    records = [record for record in records if record["run"] == run]
+    by_stage = {}
+    for record in records:
+        by_stage.setdefault(record["stage"], []).append(record)
+
+    summary = {"run": run, "stages": {record["name"]: {"wall": record["wall"], "cpu": record["cpu"]}
+                                      for record in by_stage.get("stage", [])}}
+    generation = by_stage.get("generation", [])
+    summary["generation"] = {
+        "requests": _distribution(record["wall"] for record in generation),
+        "candidates": sum(len(record["candidates"]) for record in generation),
+        "retries": _sum(generation, "retries"),
+        "failed": sum(record["status"] != "ok" for record in generation),
+        "prompt_tokens": _sum(generation, "prompt_tokens"),
+        "completion_tokens": _sum(generation, "completion_tokens"),
+        "estimated_prompt_tokens": _sum(generation, "estimated_prompt_tokens"),
+        "estimated_completion_tokens": _sum(generation, "estimated_completion_tokens"),
+        "spent": _sum(generation, "spent"),
+    }
+    evaluation = by_stage.get("evaluation", [])
+    summary["evaluation"] = {
+        "wall": _distribution(record["wall"] for record in evaluation),
+        "sandbox_wall": _distribution(record.get("sandbox_wall") for record in evaluation),
+        "sandbox_cpu": _distribution(record.get("sandbox_cpu") for record in evaluation),
+        # Round trip minus the candidate's own run: pickling, pipes and waiting for a free worker
+        "overhead": _distribution(record["wall"] - record["sandbox_wall"] for record in evaluation
+                                  if record.get("sandbox_wall") is not None),
+        "statuses": _count(record["status"] for record in evaluation),
+    }
+    summary["metrics"] = {}
+    for record in by_stage.get("metric", []):
+        summary["metrics"].setdefault(record["name"], []).append(record)
+    for name, metric_records in summary["metrics"].items():
+        summary["metrics"][name] = {
+            "wall": _distribution(record["wall"] for record in metric_records),
+            "cpu": _distribution(record.get("cpu") for record in metric_records),
+            "statuses": _count(record["status"] for record in metric_records),
+            "tiers": _count(record["tier"] for record in metric_records if record.get("tier") is not None),
+        }
+    return summary
+
+
+def _format(distribution):
+    if distribution["count"] == 0:
+        return "-"
+    return (f"n={distribution['count']} total={distribution['total']:.2f}s mean={distribution['mean']:.3f}s "
+            f"p95={distribution['p95']:.3f}s max={distribution['max']:.3f}s")
+
+
+def print_summary(summary):
+    print(f"\n=== Timings of run {summary['run']} ===")
+    for name, totals in summary["stages"].items():
+        print(f"Stage {name}: wall {totals['wall']:.2f}s, main process CPU {totals['cpu']:.2f}s")
+    generation = summary["generation"]
+    print(f"Generation requests: {_format(generation['requests'])}")
+    print(f"  {generation['candidates']} candidates, {generation['retries']} retries, {generation['failed']} failed "
+          f"requests, {generation['prompt_tokens']} prompt / {generation['completion_tokens']} completion tokens")
+    if generation["estimated_prompt_tokens"] or generation["estimated_completion_tokens"]:
+        print(f"  ~{generation['estimated_prompt_tokens']} prompt / ~{generation['estimated_completion_tokens']} "
+              f"completion tokens estimated for requests without a report")
+    if generation["spent"]:
+        print(f"  {generation['spent']} Grazie credits spent")
+    evaluation = summary["evaluation"]
+    print(f"Evaluation round trips: {_format(evaluation['wall'])}")
+    print(f"  in the sandbox: {_format(evaluation['sandbox_wall'])}")
+    print(f"  overhead: {_format(evaluation['overhead'])}")
+    print(f"  statuses: {evaluation['statuses']}")
+    for name, metric in summary["metrics"].items():
+        print(f"Metric {name}: {_format(metric['wall'])}")
+        print(f"  CPU: {_format(metric['cpu'])}, statuses: {metric['statuses']}"
+              + (f", tiers: {metric['tiers']}" if metric["tiers"] else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarizes the timings of a run")
+    parser.add_argument("run_path", help="Run directory, e.g. runs/<label>")
+    parser.add_argument("--run", help="Run id inside the timings file (defaults to the latest)")
+    args = parser.parse_args()
+    print_summary(summarize(Path(args.run_path).joinpath(TIMINGS_FILE), args.run))
@@ -0,0 +1,96 @@
+import os
+from pathlib import Path
+
+from sandbox import USAGE_FIELDS
+
+CANDIDATES_TABLE = "candidates.parquet"
+ROW_GROUP_SIZE = 65536
+
+
+def candidates_path(metrics_path: Path) -> Path:
+    return metrics_path.with_name(CANDIDATES_TABLE)
+
+
+def tasks_path(metrics_path: Path) -> Path:
+    return metrics_path.with_suffix(".parquet")
+
+
+# Columnar copy of the metrics of a run: metrics.parquet holds the scalar per-task columns of metrics.jsonl and
+# candidates.parquet one row per (task_id, candidate_index) with typed pass, sandbox usage, metric and tier columns,
+# so analysis can read just the columns it needs instead of exploding the per-candidate lists of the JSONL output.
+# Like AtomicJsonlWriter, the tables only replace the previous ones once they are complete.
+class ResultStore:
+    def __init__(self, metrics_path: Path, candidate_metrics, derived_metrics=()):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.metric_names = [metric.name for metric in candidate_metrics]
+        self.derived_names = [metric.name for metric in derived_metrics]
+        self.tier_names = [f"{metric.name}_tier" for metric in candidate_metrics if metric.tiered]
+        self.candidates_path = candidates_path(metrics_path)
+        self.tasks_path = tasks_path(metrics_path)
+        self.schema = pa.schema(
+            [("task_id", pa.string()), ("candidate_index", pa.int32()), ("passed", pa.bool_())]
+            + [(name, pa.float64()) for name in USAGE_FIELDS]
+            + [(name, pa.float64()) for name in self.metric_names]
+            + [(name, pa.float64()) for name in self.derived_names]
+            + [(name, pa.dictionary(pa.int8(), pa.string())) for name in self.tier_names]
+        )
+        self.rows = {name: [] for name in self.schema.names}
+        self.task_rows = []
+        self.writer = None
+
+    def add(self, result, cells, evaluation=None):
+        # evaluation is the task's evaluation result, with the sandbox usage of its candidates
+        self.task_rows.append({name: value for name, value in result.items() if not isinstance(value, list)})
+        passes = result["passes"]
+        usage = {name: (evaluation or {}).get(name) or [] for name in USAGE_FIELDS}
+        for i, cell in enumerate(cells):
+            self.rows["task_id"].append(cell["task_id"])
+            self.rows["candidate_index"].append(cell["candidate_index"])
+            self.rows["passed"].append(passes[i] if len(passes) == len(cells) else None)
+            for name, values in usage.items():
+                self.rows[name].append(values[i] if len(values) == len(cells) else None)
+            for name in self.metric_names + self.tier_names:
+                self.rows[name].append(cell.get(name))
+            for name in self.derived_names:
+                self.rows[name].append(result[name][i])
+        if len(self.rows["task_id"]) >= ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        batch = self.pa.RecordBatch.from_pydict(self.rows, schema=self.schema)
+        self.writer.write_batch(batch)
+        self.rows = {name: [] for name in self.schema.names}
+
+    def _tmp(self, path: Path) -> Path:
+        return path.with_name(path.name + ".tmp")
+
+    def __enter__(self):
+        import pyarrow.parquet as pq
+
+        self.writer = pq.ParquetWriter(self._tmp(self.candidates_path), self.schema)
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        import pyarrow.parquet as pq
+
+        if exc_type is not None:
+            self.writer.close()
+            self._tmp(self.candidates_path).unlink(missing_ok=True)
+            return
+        self._flush()
+        self.writer.close()
+        pq.write_table(self.pa.Table.from_pylist(self.task_rows), self._tmp(self.tasks_path))
+        os.replace(self._tmp(self.candidates_path), self.candidates_path)
+        os.replace(self._tmp(self.tasks_path), self.tasks_path)
+
+
+def open_result_store(metrics_path: Path, candidate_metrics, derived_metrics=(), enabled=True):
+    if not enabled:
+        return None
+    try:
+        return ResultStore(metrics_path, candidate_metrics, derived_metrics)
+    except ImportError:
+        print("pyarrow is not installed, skipping the Parquet result tables")
+        return None
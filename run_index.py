@@ -0,0 +1,220 @@
+import argparse
+import json
+import re
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+from checkpoints import STAGE_OUTPUTS, checkpoint_path
+from utils import iter_jsonl
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    label TEXT UNIQUE NOT NULL,
+    path TEXT NOT NULL,
+    llm TEXT,
+    dataset TEXT,
+    tasks INTEGER,
+    candidates INTEGER,
+    k INTEGER,
+    config TEXT,
+    ingested_mtime REAL
+);
+CREATE TABLE IF NOT EXISTS candidates (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    task_id TEXT NOT NULL,
+    candidate_index INTEGER NOT NULL,
+    solution TEXT,
+    passed INTEGER,
+    message TEXT,
+    PRIMARY KEY (run_id, task_id, candidate_index)
+);
+CREATE TABLE IF NOT EXISTS candidate_metrics (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    task_id TEXT NOT NULL,
+    candidate_index INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, metric, task_id, candidate_index)
+);
+CREATE TABLE IF NOT EXISTS task_results (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    task_id TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, field, task_id)
+);
+CREATE INDEX IF NOT EXISTS candidate_metrics_by_task ON candidate_metrics (metric, task_id, candidate_index);
+CREATE INDEX IF NOT EXISTS task_results_by_task ON task_results (field, task_id);
+"""
+
+
+# Run directories are named by Config.get_label(): {llm}-{dataset}-{tasks}-{candidates}, with -{k} appended by
+# earlier versions. Dataset names start with a letter, which keeps the numbers apart from the model name.
+LABEL = re.compile(r"(?P<llm>.+)-(?P<dataset>[A-Za-z][^-]*)-(?P<tasks>\d+)-(?P<candidates>\d+)(-(?P<k>\d+))?")
+
+
+def connect(index_path: Path):
+    conn = sqlite3.connect(index_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _run_mtime(run_path: Path):
+    # Later stages journal into their checkpoints, so those change whenever the run makes progress
+    paths = [run_path.joinpath("config.json")]
+    for name in STAGE_OUTPUTS:
+        paths += [run_path.joinpath(name), checkpoint_path(run_path.joinpath(name))]
+    return max((path.stat().st_mtime for path in paths if path.exists()), default=0.0)
+
+
+def label_metadata(label):
+    # llm, dataset, tasks, candidates and k of a run without config.json, all None if the name is not a label.
+    # k is None for labels without it.
+    match = LABEL.fullmatch(label)
+    if match is None:
+        return None, None, None, None, None
+    return (match["llm"], match["dataset"], int(match["tasks"]), int(match["candidates"]),
+            None if match["k"] is None else int(match["k"]))
+
+
+def _run_metadata(run_path: Path):
+    config_path = run_path.joinpath("config.json")
+    if config_path.exists():
+        with config_path.open() as f:
+            config = json.load(f)
+        evaluation = config["evaluation"]
+        return (config["model"]["llm"], config["data"]["dataset"], evaluation["tasks"], evaluation["candidates"],
+                evaluation["k"], json.dumps(config))
+    metadata = label_metadata(run_path.name)
+    if metadata[0] is None:
+        print(f"Warning: {run_path.name} has no config.json and is not named like a run label, indexing it "
+              "without metadata")
+    else:
+        print(f"Warning: {run_path.name} has no config.json, taking its metadata from the directory name")
+    return metadata + (None,)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _candidate_records(output_path: Path, candidate_indices):
+    checkpoint = checkpoint_path(output_path)
+    if checkpoint.exists():
+        yield from iter_jsonl(checkpoint)
+        return
+    # Runs from before the stage checkpoints only have per-task lists, in the order of the task's solutions
+    for result in iter_jsonl(output_path):
+        indices = candidate_indices.get(result["task_id"], [])
+        lists = {name: values for name, values in result.items()
+                 if isinstance(values, list) and len(values) == len(indices)}
+        if "passes" in lists:
+            lists["passed"] = lists.pop("passes")
+        for i, candidate_index in enumerate(indices):
+            record = {name: values[i] for name, values in lists.items()}
+            record.update(task_id=result["task_id"], candidate_index=candidate_index)
+            yield record
+
+
+def ingest_run(conn, run_path: Path):
+    label = run_path.name
+    mtime = _run_mtime(run_path)
+    row = conn.execute("SELECT run_id, ingested_mtime FROM runs WHERE label = ?", (label,)).fetchone()
+    if row is not None and row[1] >= mtime:
+        return False
+
+    solutions_path, evaluation_path, metrics_path = (run_path.joinpath(name) for name in STAGE_OUTPUTS)
+    with conn:
+        if row is not None:
+            run_id = row[0]
+            for table in ("candidates", "candidate_metrics", "task_results"):
+                conn.execute(f"DELETE FROM {table} WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+        run_id = conn.execute(
+            "INSERT INTO runs (label, path, llm, dataset, tasks, candidates, k, config, ingested_mtime) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (label, str(run_path)) + _run_metadata(run_path) + (mtime,)).lastrowid
+
+        # Per-candidate outcomes and metric values come from the stage checkpoints, per-task values from metrics.jsonl
+        candidate_indices = {}
+        for record in iter_jsonl(solutions_path):
+            candidate_indices.setdefault(record["task_id"], []).append(record["candidate_index"])
+            conn.execute(
+                "INSERT OR REPLACE INTO candidates (run_id, task_id, candidate_index, solution) VALUES (?, ?, ?, ?)",
+                (run_id, record["task_id"], record["candidate_index"], record["solution"]))
+        conn.executemany(
+            "UPDATE candidates SET passed = ?, message = ? WHERE run_id = ? AND task_id = ? AND candidate_index = ?",
+            ((record.get("passed"), record.get("message"), run_id, record["task_id"], record["candidate_index"])
+             for record in _candidate_records(evaluation_path, candidate_indices)))
+        conn.executemany(
+            "INSERT OR REPLACE INTO candidate_metrics (run_id, task_id, candidate_index, metric, value) "
+            "VALUES (?, ?, ?, ?, ?)",
+            ((run_id, cell["task_id"], cell["candidate_index"], name, value)
+             for cell in _candidate_records(metrics_path, candidate_indices)
+             for name, value in cell.items() if name not in ("task_id", "candidate_index") and
+             (value is None or _is_number(value))))
+        conn.executemany(
+            "INSERT OR REPLACE INTO task_results (run_id, task_id, field, value) VALUES (?, ?, ?, ?)",
+            ((run_id, result["task_id"], field, value)
+             for result in iter_jsonl(metrics_path)
+             for field, value in result.items() if value is None or _is_number(value)))
+    return True
+
+
+def ingest_runs(conn, runs_path: Path):
+    ingested = 0
+    for run_path in sorted(runs_path.iterdir()):
+        # Runs from before config.json was written only have their generated solutions
+        if run_path.joinpath(STAGE_OUTPUTS[0]).exists() and ingest_run(conn, run_path):
+            print(f"Indexed {run_path.name}")
+            ingested += 1
+    return ingested
+
+
+def _label_filter(labels):
+    if not labels:
+        return "", []
+    return f" AND r.label IN ({', '.join('?' * len(labels))})", list(labels)
+
+
+def task_field_table(conn, field, labels=None):
+    # task_id x run label table of one per-task field (e.g. pass@k)
+    where, params = _label_filter(labels)
+    df = pd.read_sql_query(
+        "SELECT t.task_id, r.label, t.value FROM task_results t JOIN runs r USING (run_id) "
+        f"WHERE t.field = ?{where} ORDER BY t.task_id", conn, params=[field] + params)
+    table = df.pivot(index="task_id", columns="label", values="value")
+    return table[[label for label in labels if label in table.columns]] if labels else table
+
+
+def candidate_table(conn, metrics, labels=None):
+    # One row per (run, task, candidate) with its pass flag and the requested metrics as columns
+    where, params = _label_filter(labels)
+    columns = "".join(f", MAX(CASE WHEN m.metric = ? THEN m.value END) AS \"{metric}\"" for metric in metrics)
+    return pd.read_sql_query(
+        f"SELECT r.label, c.task_id, c.candidate_index, c.passed{columns} "
+        "FROM candidates c JOIN runs r USING (run_id) "
+        "LEFT JOIN candidate_metrics m ON m.run_id = c.run_id AND m.task_id = c.task_id "
+        "AND m.candidate_index = c.candidate_index "
+        f"WHERE 1 = 1{where} GROUP BY c.run_id, c.task_id, c.candidate_index",
+        conn, params=list(metrics) + params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the results of all runs in a SQLite database")
+    parser.add_argument('--runs-dir', default='runs', help='Directory containing one directory per run')
+    parser.add_argument('--index', default='runs/index.sqlite', help='Path to the SQLite index')
+    args = parser.parse_args()
+
+    conn = connect(Path(args.index))
+    ingested = ingest_runs(conn, Path(args.runs_dir))
+    total = conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+    print(f"{ingested} runs (re)indexed, {total} runs in {args.index}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
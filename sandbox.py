@@ -0,0 +1,140 @@
+import builtins
+import gc
+import io
+import os
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import time
+from functools import partial
+
+# Kept before the guards replace them, the sandbox itself still needs to read /proc
+_open = builtins.open
+_os_open = os.open
+WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_TRUNC
+# Fields of the usage every sandboxed run reports
+USAGE_FIELDS = ("cpu_time", "wall_time", "peak_rss_mb")
+
+
+class CPUTimeExceeded(BaseException):
+    pass
+
+
+def _on_cpu_limit(signum, frame):
+    raise CPUTimeExceeded("CPU time limit exceeded")
+
+
+def _blocked(name):
+    def blocked(*args, **kwargs):
+        raise PermissionError(f"{name} is not allowed in the sandbox")
+    return blocked
+
+
+def _read_only_open(opener, name):
+    def guarded(file, mode="r", *args, **kwargs):
+        if any(flag in mode for flag in "wax+"):
+            raise PermissionError(f"Writing files is not allowed in the sandbox: {file}")
+        return opener(file, mode, *args, **kwargs)
+    guarded.__name__ = name
+    return guarded
+
+
+def _read_only_os_open(path, flags, *args, **kwargs):
+    if flags & WRITE_FLAGS:
+        raise PermissionError(f"Writing files is not allowed in the sandbox: {path}")
+    return _os_open(path, flags, *args, **kwargs)
+
+
+def _set_limit(limit, soft):
+    _, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY and (soft == resource.RLIM_INFINITY or soft > hard):
+        soft = hard
+    resource.setrlimit(limit, (soft, hard))
+
+
+def _install_guards():
+    # Guards against accidents of generated code (deleting files, opening connections, forking), not against
+    # deliberately malicious code, which could still reach the originals through other modules
+    builtins.open = io.open = _read_only_open(_open, "open")
+    os.open = _read_only_os_open
+    for module, names in ((os, ["remove", "unlink", "rename", "renames", "replace", "rmdir", "removedirs", "mkdir",
+                                "makedirs", "truncate", "chmod", "chown", "symlink", "link", "system", "fork",
+                                "forkpty", "kill", "killpg", "putenv", "unsetenv", "chdir", "fchdir", "chroot",
+                                "setuid", "execv", "execve", "execvp", "spawnv", "spawnve", "popen"]),
+                          (shutil, ["rmtree", "move", "copy", "copy2", "copyfile", "copytree", "chown"]),
+                          (subprocess, ["Popen", "call", "run", "check_call", "check_output", "getoutput"]),
+                          (socket, ["socket", "create_connection", "create_server", "socketpair", "fromfd",
+                                    "getaddrinfo"])):
+        for name in names:
+            if hasattr(module, name):
+                setattr(module, name, _blocked(f"{module.__name__}.{name}"))
+
+
+def _init_sandbox(memory_mb, open_files):
+    if memory_mb is not None:
+        _set_limit(resource.RLIMIT_AS, memory_mb * 2 ** 20)
+    if open_files is not None:
+        _set_limit(resource.RLIMIT_NOFILE, open_files)
+    signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    _install_guards()
+
+
+def sandbox_initializer(memory_mb=None, open_files=None):
+    # WorkerPool initializer: limits and guards stay in place for every job the warm worker runs
+    return partial(_init_sandbox, memory_mb, open_files)
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM (Linux), so the peak is the candidate's rather than the worker's
+    try:
+        with _open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb(reset):
+    if reset:
+        try:
+            with _open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    # Peak of the whole worker lifetime, an upper bound for the candidate
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Runs inside a sandbox worker around a job: bounds its CPU time and reports its usage along with the outcome
+def run_sandboxed(fn, args, cpu_seconds=None):
+    reset = _reset_peak_rss()
+    cpu_start = _cpu_time()
+    wall_start = time.perf_counter()
+    if cpu_seconds is not None:
+        # RLIMIT_CPU counts the worker's whole lifetime, so the budget starts at what was used so far
+        _set_limit(resource.RLIMIT_CPU, int(cpu_start + cpu_seconds) + 1)
+    try:
+        status, result = "ok", fn(*args)
+    except BaseException as e:
+        status, result = "error", f"{type(e).__name__}: {e}"
+    finally:
+        if cpu_seconds is not None:
+            _set_limit(resource.RLIMIT_CPU, resource.RLIM_INFINITY)
+    usage = {
+        "cpu_time": _cpu_time() - cpu_start,
+        "wall_time": time.perf_counter() - wall_start,
+        "peak_rss_mb": _peak_rss_mb(reset),
+    }
+    # The candidate's functions reference its namespace through __globals__, so that cycle has to be collected
+    # before the next candidate rather than whenever the collector happens to run
+    gc.collect()
+    return {"sandboxed": True, "status": status, "result": result, "usage": usage}
@@ -0,0 +1,83 @@
+import random
+import re
+import threading
+import time
+
+THROTTLE_STATUSES = {429, 503}
+
+
+def error_status(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        # Grazie reports failed requests as "<status> Error: <reason>. <body>"
+        match = re.match(r"\s*(\d{3}) Error", str(error))
+        status = int(match.group(1)) if match else None
+    return status
+
+
+def is_retryable(error, status):
+    if status is not None:
+        return status == 429 or status >= 500
+    # requests' connection errors and timeouts are OSError subclasses
+    return isinstance(error, OSError)
+
+
+# AIMD limit on in-flight requests: grows by one per window of successes, halves when throttled
+class AdaptiveLimiter:
+    def __init__(self, initial, maximum, cooldown=1.0):
+        self.limit = float(max(1, initial))
+        self.maximum = max(self.limit, float(maximum))
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_throttle = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            now = time.monotonic()
+            # One burst of 429s should only halve the limit once
+            if now - self._last_throttle >= self.cooldown:
+                self.limit = max(1.0, self.limit / 2)
+                self._last_throttle = now
+
+
+def call_with_retries(call, limiter, max_retries, backoff, stats=None):
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            result = call()
+        except Exception as e:
+            status = error_status(e)
+            if attempt >= max_retries or not is_retryable(e, status):
+                raise
+            if status in THROTTLE_STATUSES:
+                limiter.on_throttle()
+            print(f"Retrying after error (attempt {attempt + 1}/{max_retries}): {e}")
+        else:
+            limiter.on_success()
+            return result
+        finally:
+            limiter.release()
+        time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.0))
+        attempt += 1
+        if stats is not None:
+            stats["retries"] = attempt
@@ -0,0 +1,130 @@
+import hashlib
+import io
+import re
+import tokenize
+from collections import OrderedDict
+from difflib import SequenceMatcher
+
+PREPARED_CACHE_SIZE = 64
+# Fallback tokenization for code the tokenizer rejects (unterminated strings, broken indentation, prose)
+FALLBACK_TOKEN = re.compile(r"\w+|[^\w\s]")
+SKIPPED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER}
+
+# (backend, reference hash) -> prepared reference. Every candidate of a task is compared to the same reference,
+# so its preprocessing is done once per worker instead of once per candidate.
+_prepared_cache = OrderedDict()
+
+
+def code_tokens(text):
+    try:
+        tokens = []
+        for token in tokenize.generate_tokens(io.StringIO(text).readline):
+            if token.type in SKIPPED_TOKENS:
+                continue
+            # Indentation changes are structure, their whitespace is not
+            tokens.append(tokenize.tok_name[token.type] if token.type in (tokenize.INDENT, tokenize.DEDENT,
+                                                                          tokenize.NEWLINE) else token.string)
+        return tokens
+    except (tokenize.TokenError, SyntaxError):
+        return FALLBACK_TOKEN.findall(text)
+
+
+def _pattern_masks(pattern):
+    masks = {}
+    for i, symbol in enumerate(pattern):
+        masks[symbol] = masks.get(symbol, 0) | (1 << i)
+    return masks
+
+
+def _levenshtein(masks, m, text):
+    # Bit-parallel edit distance (Myers 1999, Hyyro 2003): one column of the DP matrix is a pair of m-bit vectors
+    # of +1/-1 vertical deltas, updated for a whole column per text symbol with a few integer operations
+    if m == 0:
+        return len(text)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv, score = full, 0, m
+    for symbol in text:
+        eq = masks.get(symbol, 0)
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & full) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return score
+
+
+def levenshtein(a, b):
+    return _levenshtein(_pattern_masks(b), len(b), a)
+
+
+class DifflibBackend:
+    # Exactly SequenceMatcher(None, candidate, reference).ratio(); the reference is seq2, whose index
+    # (b2j, junk and popular elements) SequenceMatcher builds once and keeps for every new seq1
+    name = "difflib"
+
+    def prepare(self, reference):
+        matcher = SequenceMatcher(None)
+        matcher.set_seq2(reference)
+        return matcher
+
+    def score(self, matcher, candidate):
+        matcher.set_seq1(candidate)
+        return matcher.ratio()
+
+
+class LevenshteinBackend:
+    # 1 - edit distance / length of the longer text, over characters
+    name = "levenshtein"
+
+    def symbols(self, text):
+        return text
+
+    def prepare(self, reference):
+        symbols = self.symbols(reference)
+        return _pattern_masks(symbols), len(symbols)
+
+    def score(self, prepared, candidate):
+        masks, m = prepared
+        symbols = self.symbols(candidate)
+        longest = max(m, len(symbols))
+        if longest == 0:
+            return 1.0
+        return 1 - _levenshtein(masks, m, symbols) / longest
+
+
+class TokenBackend(LevenshteinBackend):
+    # The same over Python tokens, so renaming a variable costs one edit per use, not one per character, and
+    # formatting and comments cost nothing
+    name = "tokens"
+
+    def symbols(self, text):
+        return code_tokens(text)
+
+
+BACKENDS = {backend.name: backend for backend in (DifflibBackend(), LevenshteinBackend(), TokenBackend())}
+
+
+def prepared_reference(backend, reference):
+    key = backend.name, hashlib.sha1(reference.encode()).hexdigest()
+    if key in _prepared_cache:
+        _prepared_cache.move_to_end(key)
+        return _prepared_cache[key]
+    prepared = backend.prepare(reference)
+    _prepared_cache[key] = prepared
+    if len(_prepared_cache) > PREPARED_CACHE_SIZE:
+        _prepared_cache.popitem(last=False)
+    return prepared
+
+
+def similarity(backend_name, candidate, reference):
+    backend = BACKENDS[backend_name]
+    return backend.score(prepared_reference(backend, reference), candidate)
+
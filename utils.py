@@ -1,6 +1,54 @@
+import hashlib
 import json
+from itertools import groupby, islice
 
 
 def load_tasks(data):
     with open(data, 'r') as f:
         return [json.loads(line) for line in f]
+
+
+def iter_jsonl(path):
+    try:
+        f = open(path, 'r')
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            # A line without a newline is the torn tail of a write interrupted by a crash
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
+def iter_tasks(data, limit=None):
+    return islice(iter_jsonl(data), limit)
+
+
+def normalize_source(code):
+    return "\n".join(line.rstrip() for line in code.splitlines() if line.strip())
+
+
+def solution_hash(solution):
+    # Solutions differing only in blank lines and trailing whitespace behave the same, so they are run and
+    # measured once
+    return hashlib.sha1(normalize_source(solution).encode()).hexdigest()
+
+
+def group_by_task(records):
+    # Records of one task are contiguous in every file the pipeline writes
+    for task_id, group in groupby(records, key=lambda record: record["task_id"]):
+        yield task_id, list(group)
+
+
+# Looks records up by task_id in a stream that is in the same order as the lookups (e.g. the dataset and the
+# solutions of a run), holding a single record in memory instead of indexing the whole file
+class OrderedLookup:
+    def __init__(self, records):
+        self.records = iter(records)
+
+    def get(self, task_id):
+        for record in self.records:
+            if record["task_id"] == task_id:
+                return record
+        raise KeyError(f"{task_id} is missing or out of order")
@@ -4,9 +4,16 @@ import os
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
+import pyarrow.parquet as pq
 
+from analysis import candidate_correlations, task_correlations
+from pass_at_k import pass_at_k
 
-def load_metrics(path):
+
+def load_metrics(path, columns=None):
+    # metrics.parquet is the columnar copy of metrics.jsonl written next to it
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
     records = []
     with open(path, 'r') as f:
         for line in f:
@@ -14,6 +21,28 @@ def load_metrics(path):
     return pd.DataFrame(records)
 
 
+def load_candidates(path, metric_cols):
+    # One row per candidate: read straight from candidates.parquet when available, otherwise explode the lists
+    candidates = os.path.join(os.path.dirname(path), 'candidates.parquet')
+    if path.endswith('.parquet') and os.path.exists(candidates):
+        available = pq.read_schema(candidates).names
+        return pd.read_parquet(candidates, columns=['task_id', 'passed'] + [c for c in metric_cols if c in available])
+    df = load_metrics(path)
+    return explode_runs(df, [c for c in metric_cols if c in df.columns])
+
+
+def recompute_pass_at_k(df, path, k):
+    # pass@k for another k than the run's, from the per-candidate pass flags
+    if 'passes' in df.columns:
+        passes = df.set_index('task_id')['passes']
+        counts = pd.DataFrame({'n': passes.map(len), 'c': passes.map(sum)})
+    else:
+        counts = load_candidates(path, []).groupby('task_id')['passed'].agg(n='size', c='sum')
+    values = {task_id: pass_at_k(int(row.n), int(row.c), k) for task_id, row in counts.iterrows()}
+    df['pass@k'] = df['task_id'].map(values)
+    return df
+
+
 def plot_pass_at_k(df, output_dir):
     plt.figure(figsize=(10, 5))
     plt.bar(df['task_id'], df['pass@k'])
@@ -66,19 +95,20 @@ def plot_histograms(df, cols, output_dir):
             plt.close()
 
 
-def explode_runs(df):
+def explode_runs(df, list_cols=None):
     # identify which columns are per‐run lists
-    list_cols = [
-        'passes',
-        'gestalt_similarity',
-        'cfg_similarity',
-        'solution_length',
-        'triviality',
-        'Interest'
-    ]
+    if list_cols is None:
+        list_cols = [
+            'passes',
+            'gestalt_similarity',
+            'cfg_similarity',
+            'solution_length',
+            'triviality',
+            'Interest'
+        ]
 
     # start by exploding the pass flags
-    exploded = df[['task_id', 'passes']].explode('passes').rename(columns={'passes': 'pass'})
+    exploded = df[['task_id', 'passes']].explode('passes').rename(columns={'passes': 'passed'})
 
     # for each metric list, explode and join back by task_id + run‐index
     for col in list_cols:
@@ -103,8 +133,8 @@ def plot_histograms_by_pass(df_runs, metric_cols, output_dir):
 
         plt.figure(figsize=(6, 4))
 
-        vals_pass = df_runs.loc[df_runs['pass'] == True, col].dropna()
-        vals_fail = df_runs.loc[df_runs['pass'] == False, col].dropna()
+        vals_pass = df_runs.loc[df_runs['passed'] == True, col].dropna()
+        vals_fail = df_runs.loc[df_runs['passed'] == False, col].dropna()
         all_vals = pd.concat([vals_pass, vals_fail])
         vmin, vmax = all_vals.min(), all_vals.max()
         edges = np.linspace(vmin, vmax, 21)
@@ -123,19 +153,52 @@ def plot_histograms_by_pass(df_runs, metric_cols, output_dir):
         plt.close()
 
 
+def plot_correlations(table, output_dir):
+    for (level, target), group in table.groupby(['level', 'target'], sort=False):
+        methods = list(group['method'].unique())
+        metrics = list(group['metric'].unique())
+        y = np.arange(len(metrics))
+        height = 0.8 / len(methods)
+
+        plt.figure(figsize=(8, max(3, len(metrics) * 0.5)))
+        for i, method in enumerate(methods):
+            rows = group[group['method'] == method].set_index('metric').reindex(metrics)
+            errors = [rows['r'] - rows['ci_low'], rows['ci_high'] - rows['r']]
+            plt.barh(y + (i - (len(methods) - 1) / 2) * height, rows['r'], height, xerr=errors, label=method,
+                     capsize=3)
+        plt.axvline(0, color='black', linewidth=0.8)
+        plt.yticks(y, metrics)
+        plt.xlabel(f'correlation with {target}')
+        plt.title(f'{level.capitalize()}-level correlations with {target} (95% bootstrap CI)')
+        plt.legend()
+        plt.tight_layout()
+        fname = f'correlations_{level}_{target}.png'.replace(' ', '_').replace(':', '').replace('@', '_at_')
+        plt.savefig(os.path.join(output_dir, fname))
+        plt.close()
+
+
 def main():
     parser = argparse.ArgumentParser(description="Visualize HumanEval metrics from JSONL file with configurable plots")
-    parser.add_argument('--metrics',      required=True, help='Path to metrics JSONL file')
+    parser.add_argument('--metrics',      required=True, help='Path to metrics JSONL or Parquet file')
     parser.add_argument('--output-dir',   default='visualizations', help='Directory to save output plots')
     parser.add_argument('--no-bar',       action='store_true', help='Skip bar plot of pass@k')
     parser.add_argument('--scatter',      nargs=2, metavar=('X_COL', 'Y_COL'), help='Plot scatter of two columns')
     parser.add_argument('--heatmap',      action='store_true', help='Include correlation heatmap')
     parser.add_argument('--hist',         nargs='+', metavar='COL', help='List of columns for histogram plots')
     parser.add_argument('--pass-by-sol', action='store_true')
+    parser.add_argument('--k',            type=int, help='Recompute pass@k for this k instead of the run\'s one')
+    parser.add_argument('--correlations', action='store_true',
+                        help='Correlate metrics with pass@k (per task) and with passing (per candidate), '
+                             'with bootstrap confidence intervals and permutation p-values')
+    parser.add_argument('--resamples',    type=int, default=2000, help='Bootstrap resamples and permutations')
     args = parser.parse_args()
+    if args.k is not None and args.k < 1:
+        parser.error('--k must be at least 1')
 
     os.makedirs(args.output_dir, exist_ok=True)
     df = load_metrics(args.metrics)
+    if args.k is not None:
+        df = recompute_pass_at_k(df, args.metrics, args.k)
 
     # bar chart
     if not args.no_bar:
@@ -145,13 +208,25 @@ def main():
             print("Warning: 'pass@k' column not found, skipping bar plot.")
 
     if args.pass_by_sol:
-        e_df = explode_runs(df)
-        plot_histograms_by_pass(e_df, ['gestalt_similarity',
+        metric_cols = ['gestalt_similarity',
         'cfg_similarity',
         'solution_length',
         'triviality',
         'Interest'
-    ], args.output_dir)
+    ]
+        e_df = load_candidates(args.metrics, metric_cols)
+        plot_histograms_by_pass(e_df, metric_cols, args.output_dir)
+
+    if args.correlations:
+        candidate_cols = ['gestalt_similarity', 'cfg_similarity', 'solution_length', 'triviality', 'Interest']
+        table = pd.concat([
+            task_correlations(df, resamples=args.resamples),
+            candidate_correlations(load_candidates(args.metrics, candidate_cols), candidate_cols,
+                                   resamples=args.resamples),
+        ], ignore_index=True)
+        table.to_csv(os.path.join(args.output_dir, 'correlations.csv'), index=False)
+        print(table.to_string(index=False))
+        plot_correlations(table, args.output_dir)
 
     # scatter plot
     if args.scatter:
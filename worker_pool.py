@@ -0,0 +1,297 @@
+import builtins
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from itertools import count
+from multiprocessing.connection import wait
+from types import ModuleType
+
+# Yielded by a job source that has nothing to submit yet; the pool keeps collecting results and asks again later
+PENDING = object()
+PENDING_POLL_INTERVAL = 0.05
+# Pools start and replace workers from the pipeline's stage threads, and forking a threaded process can copy a lock
+# another thread holds. Workers are forked from a single-threaded server instead, which imports the job modules once
+# (from the working directory, as when main.py is run from the repository).
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+FORKSERVER_PRELOAD = ["execution", "metrics"]
+_MISSING = object()
+
+
+def _module_attributes(names):
+    # name -> (attributes, their values in order) of every loaded module
+    attributes = {}
+    for name in names:
+        namespace = getattr(sys.modules.get(name), "__dict__", None)
+        if namespace is not None:
+            attributes[name] = dict(namespace), tuple(namespace.values())
+    return attributes
+
+
+def _state_snapshot():
+    return {
+        "builtins": dict(vars(builtins)),
+        "streams": (sys.stdin, sys.stdout, sys.stderr),
+        "path": list(sys.path),
+        "cwd": os.getcwd(),
+        "recursion_limit": sys.getrecursionlimit(),
+        "modules": _module_attributes(list(sys.modules)),
+    }
+
+
+def _module_changed(namespace, attributes, values):
+    # Comparing the values as one tuple is fast for the usual untouched module, since equal items are found
+    # identical before their __eq__ would be called
+    try:
+        if len(namespace) == len(attributes) and tuple(namespace.values()) == values:
+            return False
+    except Exception:  # e.g. the ambiguous truth value of an array that replaced another
+        return True
+    if any(namespace.get(key, _MISSING) is not value for key, value in attributes.items()):
+        return True
+    # New attributes are only allowed for submodules the job imported
+    return not all(isinstance(namespace[key], ModuleType) for key in namespace.keys() - attributes.keys())
+
+
+def _modules_changed(clean_modules):
+    # A job that replaced a function of a shared module (e.g. math.floor) would break every later job in the worker
+    grown = []
+    for name, (attributes, values) in clean_modules.items():
+        namespace = getattr(sys.modules.get(name), "__dict__", None)
+        if namespace is None or _module_changed(namespace, attributes, values):
+            return True
+        if len(namespace) != len(attributes):
+            grown.append(name)
+    # Packages with new submodules and modules a job imported for the first time are checked from the state that
+    # job left them in
+    clean_modules.update(_module_attributes(grown + list(sys.modules.keys() - clean_modules.keys())))
+    return False
+
+
+def _is_dirty(clean_state):
+    builtins_now = vars(builtins)
+    if builtins_now.keys() != clean_state["builtins"].keys() or \
+            any(builtins_now[name] is not value for name, value in clean_state["builtins"].items()):
+        # Restore enough of the interpreter to report the result before the worker retires
+        builtins_now.clear()
+        builtins_now.update(clean_state["builtins"])
+        return True
+    if (sys.stdin, sys.stdout, sys.stderr) != clean_state["streams"]:
+        sys.stdin, sys.stdout, sys.stderr = clean_state["streams"]
+        return True
+    if sys.path != clean_state["path"] or os.getcwd() != clean_state["cwd"] or \
+            sys.getrecursionlimit() != clean_state["recursion_limit"]:
+        return True
+    return _modules_changed(clean_state["modules"])
+
+
+def _worker_loop(conn, initializer, max_jobs):
+    if initializer is not None:
+        initializer()
+    clean_state = _state_snapshot()
+    jobs_done = 0
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        job_id, fn, args = job
+        try:
+            message = (job_id, "ok", fn(*args))
+        except BaseException as e:  # candidates may raise SystemExit and friends
+            message = (job_id, "error", f"{type(e).__name__}: {e}")
+        jobs_done += 1
+        # Retire the worker when a job tampered with interpreter-wide state or it has served enough jobs
+        retire = _is_dirty(clean_state) or (max_jobs is not None and jobs_done >= max_jobs)
+        try:
+            conn.send(message + (retire,))
+        except Exception as e:  # unpicklable result
+            conn.send((job_id, "error", f"Unpicklable result: {e}", retire))
+        if retire:
+            break
+
+
+def run_job(fn, args):
+    # For job sources that pick the function per job, e.g. by evaluation mode
+    return fn(*args)
+
+
+class _Worker:
+    def __init__(self, ctx, initializer, max_jobs):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_loop, args=(child_conn, initializer, max_jobs), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.deadline = None
+        self.submitted = None
+
+    def submit(self, job_id, fn, args, timeout):
+        self.conn.send((job_id, fn, args))
+        self.job = job_id
+        self.submitted = time.perf_counter()
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+# Pool of pre-forked workers that are reused across jobs. Unlike multiprocessing.Pool, each job gets its own
+# timeout, and a worker that hangs, dies or corrupts its interpreter is replaced without affecting the others.
+class WorkerPool:
+    def __init__(self, processes=None, timeout=None, max_jobs_per_worker=None, initializer=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.initializer = initializer
+        self.ctx = multiprocessing.get_context(START_METHOD)
+        if START_METHOD == "forkserver":
+            self.ctx.set_forkserver_preload(FORKSERVER_PRELOAD)
+        # Workers are only started once there is a job for them
+        self.workers = []
+        # Seconds from submitting the job last yielded by imap_unordered to its result
+        self.last_duration = None
+
+    def _spawn(self):
+        return _Worker(self.ctx, self.initializer, self.max_jobs_per_worker)
+
+    def _replace(self, worker, kill):
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+        index = self.workers.index(worker)
+        self.workers[index] = self._spawn()
+        return self.workers[index]
+
+    def imap_unordered(self, fn, jobs, timeout=None):
+        # Yields (index, status, result) with status one of "ok", "error", "timeout" or "crash".
+        # A job source fed by another stage yields PENDING while it has nothing to submit yet.
+        timeout = self.timeout if timeout is None else timeout
+        jobs = iter(jobs)
+        job_ids = count()
+        idle = list(self.workers)
+        busy = {}
+        exhausted = False
+        try:
+            while True:
+                stalled = False
+                while (idle or not self.workers) and not exhausted:
+                    try:
+                        args = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if args is PENDING:
+                        stalled = True
+                        break
+                    if not self.workers:
+                        self.workers = [self._spawn() for _ in range(self.processes)]
+                        idle = list(self.workers)
+                    job_id = next(job_ids)
+                    worker = idle.pop()
+                    try:
+                        worker.submit(job_id, fn, args, timeout)
+                    except OSError:  # the worker died while idle
+                        worker = self._replace(worker, kill=True)
+                        worker.submit(job_id, fn, args, timeout)
+                    busy[worker.conn] = worker
+                if not busy:
+                    if exhausted:
+                        return
+                    time.sleep(PENDING_POLL_INTERVAL)
+                    continue
+
+                deadlines = [w.deadline for w in busy.values() if w.deadline is not None]
+                if stalled:
+                    deadlines.append(time.monotonic() + PENDING_POLL_INTERVAL)
+                wait_for = None if not deadlines else max(0.0, min(deadlines) - time.monotonic())
+                for conn in wait(list(busy), timeout=wait_for):
+                    worker = busy.pop(conn)
+                    try:
+                        job_id, status, result, retire = conn.recv()
+                    except (EOFError, OSError):
+                        self.last_duration = time.perf_counter() - worker.submitted
+                        idle.append(self._replace(worker, kill=True))
+                        yield worker.job, "crash", f"Worker exited with code {worker.process.exitcode}"
+                        continue
+                    self.last_duration = time.perf_counter() - worker.submitted
+                    idle.append(self._replace(worker, kill=False) if retire else worker)
+                    yield job_id, status, result
+
+                now = time.monotonic()
+                for conn, worker in list(busy.items()):
+                    if worker.deadline is not None and worker.deadline <= now:
+                        del busy[conn]
+                        self.last_duration = time.perf_counter() - worker.submitted
+                        idle.append(self._replace(worker, kill=True))
+                        yield worker.job, "timeout", "Timeout"
+        finally:
+            # Workers still busy when the caller stops iterating would deliver stale results later
+            for worker in busy.values():
+                self._replace(worker, kill=True)
+
+    def map(self, fn, jobs, timeout=None):
+        results = {}
+        for job_id, status, result in self.imap_unordered(fn, jobs, timeout):
+            results[job_id] = (status, result)
+        return [results[i] for i in range(len(results))]
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Hands out the jobs of a stream of tasks and writes each task's result in input order once all of its units are
+# done, while jobs finish in any order. The job source passed to imap_unordered calls start() for a task before
+# yielding its jobs and submit() for every job it yields, so the ids match the pool's. The pool pulls jobs whenever
+# a worker is free, so only a few tasks are held in memory at a time.
+class OrderedResults:
+    def __init__(self, write):
+        self.write = write
+        self.unfinished = deque()
+        self.in_flight = {}
+        self.job_ids = count()
+
+    def start(self, state, pending):
+        # Counted before the first job is submitted, so the task cannot look finished while it is half submitted
+        state["pending"] = pending
+        self.unfinished.append(state)
+        self._write_finished()
+
+    def submit(self, job):
+        self.in_flight[next(self.job_ids)] = job
+
+    def take(self, job_id):
+        return self.in_flight.pop(job_id)
+
+    def done(self, state, units=1):
+        state["pending"] -= units
+        self._write_finished()
+
+    def _write_finished(self):
+        while self.unfinished and self.unfinished[0]["pending"] == 0:
+            self.write(self.unfinished.popleft())